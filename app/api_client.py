@@ -0,0 +1,86 @@
+# standard library modules
+import json
+
+# third-party modules
+import requests
+
+# local modules
+from constants import CHAT_API_TIMEOUT
+from clients import get_or_create
+from streaming import CURSOR
+
+"""
+A client of the HTTP API served by server.py, used by main.py when CHAT_API_URL is set.
+"""
+class ChatApiClient:
+    def __init__(self, base_url, timeout=CHAT_API_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def chat(self, conversation_id, message):
+        response = self.session.post(self.base_url + '/chat', json={'conversation_id': conversation_id, 'message': message}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    """
+    Yields (event, data) for the server-sent events of a streamed turn: "delta" and "replace" events
+    with the answer so far, then "done" with the same result as chat(), or "error".
+    """
+    def stream(self, conversation_id, message):
+        with self.session.post(self.base_url + '/chat/stream', json={'conversation_id': conversation_id, 'message': message}, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = 'utf-8'
+            event, data = None, []
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data.append(line[len('data:'):].strip())
+                elif not line and event:
+                    yield event, json.loads("\n".join(data))
+                    event, data = None, []
+
+    def feedback(self, queryid, resultids, relevance_value, click_key=None):
+        response = self.session.post(self.base_url + '/feedback', json={'queryid': queryid, 'resultids': resultids, 'relevance': relevance_value, 'click_key': click_key}, timeout=self.timeout)
+        response.raise_for_status()
+
+    def load(self, conversation_id):
+        response = self.session.get(self.base_url + '/conversations/' + conversation_id, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def delete(self, conversation_id):
+        self.session.delete(self.base_url + '/conversations/' + conversation_id, timeout=self.timeout)
+
+
+def get_api_client(base_url):
+    return get_or_create('api_client', lambda: ChatApiClient(base_url))
+
+
+"""
+The API counterpart of function.respond(): sends the message of the conversation `conversation_id`
+and adds the message and the reply to `state` the same way. When a `placeholder` is given the
+answer is streamed into it.
+"""
+def respond_via_api(client, conversation_id, user_input, state, placeholder=None):
+    if placeholder is None:
+        result = client.chat(conversation_id, user_input)
+    else:
+        text, result = "", None
+        for event, data in client.stream(conversation_id, user_input):
+            if event in ('delta', 'replace'):
+                text = text + data['text'] if event == 'delta' else data['text']
+                placeholder.markdown(text + CURSOR)
+            elif event == 'done':
+                result = data
+            elif event == 'error':
+                raise RuntimeError(data['error'])
+        placeholder.empty()
+
+    state['past'].append(user_input)
+    state['generated'].append(result['answer'])
+    state['queryid'].append(result['queryid'])
+    state['resultids'].append(result['resultids'])
+    state['lang'] = result.get('lang', 'en')
+    return result['answer']
@@ -0,0 +1,338 @@
+# standard library modules
+import argparse
+import contextlib
+import csv
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, List, Optional
+
+# third-party modules
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+# local modules
+import clients
+import translation
+from cache import Cache
+from history import ChatHistory
+from logsink import LogSink
+from tracing import (
+    add_listener,
+    percentile
+)
+
+"""
+Offline load test for the chat pipeline. Kendra, OpenAI and the detect / translate services are
+replaced by in-process stand-ins with configurable latency, and a question set is replayed across N
+concurrent simulated sessions through the same code path as main.py (function.respond). Reports
+throughput, end-to-end tail latency and a per-stage breakdown, without using any API quota, e.g.
+    python app/bench.py --sessions 20 --turns 5 --llm-ms 1200 --kendra-ms 250
+"""
+
+DEFAULT_QUESTIONS = [
+    "How do I change employer?",
+    "How many rest days do I get each month?",
+    "Can my employer keep my passport?",
+    "What should I do if my salary is not paid?",
+    "Can I work part-time for another employer?",
+    "How do I renew my work permit?",
+    "What happens if my employer cancels my work permit?",
+    "Who pays for my medical treatment?",
+]
+
+DEFAULT_PASSAGES = [
+    "Migrant domestic workers are entitled to one rest day every week. Employers may compensate the worker in lieu of a rest day if both parties agree in writing.",
+    "Employers must pay the salary of a migrant domestic worker no later than 7 days after the end of the salary period.",
+    "To change employer, the worker can get a new employer to apply for a work permit while the current work permit is still valid, with the current employer's consent.",
+    "Employers should not keep the worker's passport or work permit card. The worker can call the MDW helpline for help.",
+    "Employers are responsible for the upkeep and medical treatment of their migrant domestic worker, including buying medical insurance.",
+]
+
+
+"""
+Samples latencies (in seconds) from a lognormal distribution with the given median and p95, in ms.
+"""
+class Latency:
+    def __init__(self, median_ms, p95_ms=None):
+        self.median = median_ms / 1000.0
+        p95 = (p95_ms or median_ms * 2) / 1000.0
+        self.sigma = math.log(p95 / self.median) / 1.645 if self.median and p95 > self.median else 0.0
+
+    def sample(self):
+        if not self.median:
+            return 0.0
+        return self.median * math.exp(self.sigma * random.gauss(0, 1))
+
+    def sleep(self):
+        time.sleep(self.sample())
+
+
+"""
+Stands in for the boto3 Kendra client: query / retrieve return passages with Kendra-shaped result
+ids ("<query id>-<result id>"), describe_index returns a fixed index version.
+"""
+class FakeKendraClient:
+    def __init__(self, latency, passages, top_k=3):
+        self.latency = latency
+        self.passages = passages
+        self.top_k = top_k
+        self.calls = {'query': 0, 'retrieve': 0, 'submit_feedback': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _results(self, text):
+        query_id = str(uuid.uuid4())
+        words = set(text.lower().split())
+        ranked = sorted(self.passages, key=lambda p: -len(words & set(p.lower().split())))[:self.top_k]
+        return query_id, [
+            {
+                'Id': f"{query_id}-{uuid.uuid4()}",
+                'DocumentId': f"doc-{n}",
+                'DocumentURI': f"https://www.mom.gov.sg/faq/{n}",
+                'DocumentTitle': {'Text': f"MDW FAQ {n}"},
+                'DocumentExcerpt': {'Text': passage},
+                'Content': passage,
+                'Type': 'DOCUMENT',
+                'ScoreAttributes': {'ScoreConfidence': 'HIGH'},
+                'AdditionalAttributes': [],
+                'DocumentAttributes': [],
+            }
+            for n, passage in enumerate(ranked)
+        ]
+
+    def query(self, **kwargs):
+        self._count('query')
+        self.latency.sleep()
+        query_id, items = self._results(kwargs.get('QueryText', ''))
+        return {'QueryId': query_id, 'ResultItems': items, 'TotalNumberOfResults': len(items)}
+
+    def retrieve(self, **kwargs):
+        self._count('retrieve')
+        self.latency.sleep()
+        query_id, items = self._results(kwargs.get('QueryText', ''))
+        for item in items:
+            item['DocumentTitle'] = item['DocumentTitle']['Text']
+        return {'QueryId': query_id, 'ResultItems': items}
+
+    def submit_feedback(self, **kwargs):
+        self._count('submit_feedback')
+        self.latency.sleep()
+        return {}
+
+    def describe_index(self, **kwargs):
+        return {'UpdatedAt': 'bench', 'IndexStatistics': {}}
+
+
+"""
+Stands in for ChatOpenAI. Waits for a sampled time to first token, then produces `answer_tokens`
+tokens at `tokens_per_second`, streaming them through the callbacks like the real client. The
+condense prompt is answered with the follow-up question unchanged.
+"""
+class FakeChatModel(BaseChatModel):
+    first_token: Any
+    tokens_per_second: float = 60.0
+    answer_tokens: int = 120
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        prompt = messages[-1].content
+        self.first_token.sleep()
+
+        if "Follow up question:" in prompt:
+            text = prompt.rsplit("Follow up question:", 1)[1].strip()
+        else:
+            text = ""
+            for n in range(self.answer_tokens):
+                token = ("Step %d. " % (n // 12 + 1)) if n % 12 == 0 else "word "
+                text += token
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+                time.sleep(1.0 / self.tokens_per_second)
+
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop=stop)
+
+
+"""
+Stand-ins for deep_translator. Foreign messages are simulated as "[<lang>] <english text>".
+"""
+class FakeTranslator:
+    latency = Latency(0)
+
+    def __init__(self, source='auto', target='en'):
+        self.source = source
+        self.target = target
+
+    def translate(self, text):
+        FakeTranslator.latency.sleep()
+        if self.target == 'en':
+            return text.split("] ", 1)[1] if text.startswith("[") else text
+        return f"[{self.target}] {text}"
+
+
+class FakeLanguage:
+    def __init__(self, lang, prob):
+        self.lang = lang
+        self.prob = prob
+
+
+# Local detection stays in-process, so only the remote fallback pays the service latency
+def fake_detect_langs(text):
+    if text.startswith("["):
+        return [FakeLanguage(text[1:text.index("]")], 1.0)]
+    return [FakeLanguage('en', 1.0)]
+
+
+def fake_single_detection(text, api_key=None):
+    FakeTranslator.latency.sleep()
+    return fake_detect_langs(text)[0].lang
+
+
+class NullBackend:
+    def write_rows(self, file_path, header, rows):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullPlaceholder:
+    def markdown(self, text):
+        pass
+
+    def empty(self):
+        pass
+
+
+def load_questions(path):
+    if not path or not os.path.exists(path):
+        return DEFAULT_QUESTIONS, DEFAULT_PASSAGES
+    with open(path, mode='r', encoding='unicode_escape') as f:
+        rows = list(csv.DictReader(f))
+    questions = [r['Question'] for r in rows if r.get('Question')]
+    passages = [r['Reference'] for r in rows if r.get('Reference')]
+    return questions or DEFAULT_QUESTIONS, passages or DEFAULT_PASSAGES
+
+
+"""
+Replaces every external dependency in the client registry and the translation module.
+"""
+def install_fakes(args, passages):
+    clients.reset()
+    kendra = FakeKendraClient(Latency(args.kendra_ms, args.kendra_p95_ms), passages)
+    llm = FakeChatModel(first_token=Latency(args.llm_ms, args.llm_p95_ms), tokens_per_second=args.tokens_per_second, answer_tokens=args.answer_tokens)
+    clients.override('kendra', kendra)
+    clients.override('llm', llm)
+    clients.override('llm_streaming', llm)
+    clients.override('log_sink', LogSink(NullBackend()))
+    clients.override('answer_cache', Cache(args.cache_size if args.cache else 1, 3600 if args.cache else 0))
+    if not args.cache:
+        clients.override('retrieval_cache', Cache(1, 0))
+        clients.override('translation_cache', Cache(1, 0))
+
+    FakeTranslator.latency = Latency(args.translate_ms, args.translate_p95_ms)
+    translation.GoogleTranslator = FakeTranslator
+    translation.detect_langs = fake_detect_langs
+    translation.single_detection = fake_single_detection
+    return kendra, llm
+
+
+def run_session(chain, questions, args, session, results):
+    from function import respond
+
+    rng = random.Random(session)
+    lang = 'tl' if rng.random() < args.foreign else 'en'
+    state = {'history': ChatHistory(), 'generated': [], 'past': [], 'queryid': [], 'resultids': []}
+    placeholder = NullPlaceholder() if args.streaming else None
+
+    for turn in range(args.turns):
+        question = questions[(session * args.turns + turn) % len(questions)] if args.spread else questions[turn % len(questions)]
+        if lang != 'en':
+            question = f"[{lang}] {question}"
+        try:
+            respond(chain, question, state, placeholder=placeholder)
+        except Exception as e:
+            results['errors'].append(repr(e))
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the chat pipeline, with local stand-ins for Kendra, OpenAI and the translator.")
+    parser.add_argument('--questions', default='./app/prev_records/labeled_criteria_pre.csv', help="CSV with a Question column (and Reference passages)")
+    parser.add_argument('--sessions', type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument('--turns', type=int, default=3, help="turns per session")
+    parser.add_argument('--spread', action='store_true', help="give each session different questions instead of the same sequence")
+    parser.add_argument('--foreign', type=float, default=0.5, help="fraction of sessions writing in another language")
+    parser.add_argument('--streaming', action='store_true', help="stream answers as main.py does with STREAMING")
+    parser.add_argument('--cache', action='store_true', help="keep the answer, retrieval and translation caches enabled")
+    parser.add_argument('--cache-size', type=int, default=1000)
+    parser.add_argument('--think-ms', type=float, default=0, help="pause between turns of a session")
+    parser.add_argument('--llm-ms', type=float, default=800, help="median time to first token")
+    parser.add_argument('--llm-p95-ms', type=float, default=None)
+    parser.add_argument('--tokens-per-second', type=float, default=60)
+    parser.add_argument('--answer-tokens', type=int, default=120)
+    parser.add_argument('--kendra-ms', type=float, default=250)
+    parser.add_argument('--kendra-p95-ms', type=float, default=None)
+    parser.add_argument('--translate-ms', type=float, default=150)
+    parser.add_argument('--translate-p95-ms', type=float, default=None)
+    parser.add_argument('--verbose', action='store_true', help="keep the pipeline's console output")
+    args = parser.parse_args()
+
+    questions, passages = load_questions(args.questions)
+    kendra, llm = install_fakes(args, passages)
+
+    from function import (
+        start_conversation,
+        get_inflight_group
+    )
+    chain = start_conversation(streaming=args.streaming)
+
+    results = {'latencies': [], 'stages': {}, 'errors': []}
+    lock = threading.Lock()
+
+    def collect(trace, total_ms):
+        with lock:
+            results['latencies'].append(total_ms)
+            for name, ms in trace.durations().items():
+                results['stages'].setdefault(name, []).append(ms)
+    add_listener(collect)
+
+    threads = [threading.Thread(target=run_session, args=(chain, questions, args, n, results)) for n in range(args.sessions)]
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = results['latencies']
+    print(f"sessions {args.sessions}, turns {len(latencies)}, errors {len(results['errors'])}, {elapsed:.1f}s")
+    print(f"throughput {len(latencies) / elapsed:.2f} turns/s")
+    print(f"end-to-end ms  p50 {percentile(latencies, 50):.0f}  p95 {percentile(latencies, 95):.0f}  p99 {percentile(latencies, 99):.0f}")
+    print(f"upstream calls  llm {llm.calls}  kendra {kendra.calls['query'] + kendra.calls['retrieve']}")
+    print(f"coalesced turns {get_inflight_group().stats()['shared']}")
+    print(f"{'stage':<16}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, values in sorted(results['stages'].items(), key=lambda item: -percentile(item[1], 50)):
+        print(f"{name:<16}{len(values):>8}{percentile(values, 50):>10.0f}{percentile(values, 95):>10.0f}{percentile(values, 99):>10.0f}")
+    for error in sorted(set(results['errors']))[:5]:
+        print("error:", error)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# standard library modules
+import hashlib
+import os
+
+# third-party modules
+import torch
+from bert_score import BERTScorer
+
+# local modules
+from cache import Cache
+from clients import get_or_create
+
+BERTSCORE_LANG = 'en'
+BERTSCORE_BATCH_SIZE = int(os.getenv("BERTSCORE_BATCH_SIZE", "64"))
+BERTSCORE_THREADS = int(os.getenv("BERTSCORE_THREADS", str(os.cpu_count() or 1)))
+BERTSCORE_CACHE_PATH = './app/prev_records/bertscore_cache.sqlite3'
+
+"""
+The BERTScore model is loaded once per process and reused for every batch.
+"""
+def _create_scorer():
+    if not torch.cuda.is_available():
+        torch.set_num_threads(BERTSCORE_THREADS)
+    return BERTScorer(lang=BERTSCORE_LANG, batch_size=BERTSCORE_BATCH_SIZE)
+
+
+def get_scorer():
+    return get_or_create('bertscore_scorer', _create_scorer)
+
+
+def get_cache():
+    # Scores never go stale for a given model, so entries are kept for ten years
+    return get_or_create('bertscore_cache', lambda: Cache(maxsize=1000000, ttl=10 * 365 * 24 * 60 * 60, path=BERTSCORE_CACHE_PATH, table='bertscore'))
+
+
+def _key(candidate, reference):
+    return hashlib.sha256("\x1f".join([BERTSCORE_LANG, candidate, reference]).encode()).hexdigest()
+
+
+"""
+Scores (candidate, reference) pairs and returns one (precision, recall, f1) tuple per pair. Pairs
+scored before are served from the on-disk cache; the rest are scored together in padded batches
+of BERTSCORE_BATCH_SIZE.
+"""
+def score_pairs(candidates, references):
+    cache = get_cache()
+    keys = [_key(str(c), str(r)) for c, r in zip(candidates, references)]
+    results = [cache.get(k) for k in keys]
+
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        P, R, F1 = get_scorer().score(
+            [str(candidates[i]) for i in missing],
+            [str(references[i]) for i in missing],
+            verbose=len(missing) > BERTSCORE_BATCH_SIZE
+        )
+        for n, i in enumerate(missing):
+            results[i] = [P[n].item(), R[n].item(), F1[n].item()]
+        cache.put_many([(keys[i], results[i]) for i in missing])
+
+    return [tuple(r) for r in results]
@@ -0,0 +1,121 @@
+# standard library modules
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# third-party modules
+from cachetools import TTLCache
+
+"""
+A thread-safe LRU cache with TTL expiry, optionally backed by a SQLite file so entries survive
+restarts and are shared by every process on the host. Values must be JSON serialisable.
+
+The in-memory layer is checked first; on a miss the SQLite layer is consulted and a fresh entry is
+promoted back into memory.
+"""
+class Cache:
+    def __init__(self, maxsize, ttl, path=None, table='cache', getsizeof=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=getsizeof)
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+            self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is None and self._db is not None:
+                value = self._get_from_disk(key)
+                if value is not None:
+                    self._set_memory(key, value)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    # Stores a batch of (key, value) pairs in one transaction, pruning the SQLite layer once
+    def put_many(self, items):
+        with self._lock:
+            for key, value in items:
+                self._set_memory(key, value)
+            if self._db is not None:
+                now = time.time()
+                self._db.executemany(
+                    f'INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                    [(key, json.dumps(value, default=str), now, now) for key, value in items]
+                )
+                self._prune()
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute(f'DELETE FROM {self.table}')
+                self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._memory),
+        }
+
+    def _set_memory(self, key, value):
+        try:
+            self._memory[key] = value
+        except ValueError:
+            # A single value larger than the whole cache is simply not cached in memory
+            pass
+
+    def _get_from_disk(self, key):
+        row = self._db.execute(f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, created = row
+        if time.time() - created > self.ttl:
+            self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            self._db.commit()
+            return None
+
+        self._db.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (time.time(), key))
+        self._db.commit()
+        return json.loads(value)
+
+    # Drops expired rows, then the least recently used rows beyond maxsize
+    def _prune(self):
+        self._db.execute(f'DELETE FROM {self.table} WHERE created < ?', (time.time() - self.ttl,))
+        self._db.execute(
+            f'DELETE FROM {self.table} WHERE key NOT IN (SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT ?)',
+            (self.maxsize,)
+        )
+
+
+"""
+Normalises a question into a cache key: case, punctuation and whitespace differences are ignored.
+"""
+def normalize_question(question):
+    question = question.casefold()
+    question = re.sub(r"[^\w\s]", " ", question)
+    return " ".join(question.split())
@@ -0,0 +1,138 @@
+# standard library modules
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# third-party modules
+import boto3
+import openai
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+
+# local modules
+from constants import (
+    MODEL_NAME,
+    OPENAI_API_KEY,
+    OPENAI_API_KEYS,
+    LLM_MAX_ATTEMPTS,
+    TEMPERATURE,
+    AWS_DEFAULT_REGION,
+    HTTP_POOL_SIZE,
+    PIPELINE_WORKERS
+)
+from llm_pool import (
+    KeyPool,
+    PooledChatModel
+)
+
+"""
+Process-wide registry of clients and chains.
+
+Streamlit re-executes main.py on every interaction of every session, so anything that is expensive
+to build (boto3 clients, HTTP connection pools, LLM clients, chains) is created once here and shared
+by all sessions. None of these objects hold per-session state: the chat history lives in
+st.session_state and is passed in on every call.
+"""
+_registry = {}
+_lock = threading.RLock()
+
+
+def get_or_create(name, factory):
+    resource = _registry.get(name)
+    if resource is None:
+        with _lock:
+            resource = _registry.get(name)
+            if resource is None:
+                resource = factory()
+                _registry[name] = resource
+    return resource
+
+
+"""
+Replaces a registered resource, e.g. to swap in a stub client.
+"""
+def override(name, resource):
+    with _lock:
+        _registry[name] = resource
+
+
+def reset():
+    with _lock:
+        _registry.clear()
+
+
+def _create_kendra_client():
+    # boto3 sessions are not thread-safe, clients are; build the client from a private session
+    session = boto3.session.Session()
+    return session.client(
+        'kendra',
+        region_name=AWS_DEFAULT_REGION,
+        config=Config(
+            max_pool_connections=HTTP_POOL_SIZE,
+            retries={'max_attempts': 3, 'mode': 'adaptive'}
+        )
+    )
+
+
+def get_kendra_client():
+    return get_or_create('kendra', _create_kendra_client)
+
+
+def _create_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+"""
+A single keep-alive session shared by every OpenAI call, so TLS handshakes are paid once per
+connection instead of once per thread.
+"""
+def get_http_session():
+    session = get_or_create('http_session', _create_http_session)
+    openai.requestssession = session
+    return session
+
+
+def _create_key_pool():
+    pool = KeyPool(OPENAI_API_KEYS or [OPENAI_API_KEY])
+    get_http_session().hooks['response'].append(pool.observe_response)
+    return pool
+
+
+"""
+The OpenAI keys shared by every LLM client, with their remaining quota; stats() gives the per-key
+utilization.
+"""
+def get_key_pool():
+    return get_or_create('key_pool', _create_key_pool)
+
+
+def _create_llm(streaming=False):
+    return PooledChatModel.create(
+            get_key_pool(),
+            max_attempts=LLM_MAX_ATTEMPTS,
+            temperature=TEMPERATURE,
+            model_name=MODEL_NAME,
+            streaming=streaming,
+            verbose=True
+        )
+
+
+"""
+The streaming client emits on_llm_new_token callbacks as tokens arrive; the result is the same.
+"""
+def get_llm(streaming=False):
+    if streaming:
+        return get_or_create('llm_streaming', lambda: _create_llm(streaming=True))
+    return get_or_create('llm', _create_llm)
+
+
+"""
+Thread pool shared by all sessions for pipeline stages that run concurrently or in the background.
+Work submitted here must not touch st.session_state or Streamlit elements.
+"""
+def get_executor():
+    return get_or_create('executor', lambda: ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline'))
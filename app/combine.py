@@ -0,0 +1,199 @@
+# standard library modules
+import re
+import sys
+
+# third-party modules
+from langchain.chains import LLMChain
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain.prompts import PromptTemplate
+from langchain.schema import Document
+
+# local modules
+from constants import (
+    MODEL_NAME,
+    COMBINE_STUFF_TOKENS,
+    COMBINE_PASSAGE_TOKENS,
+    COMBINE_MIN_SCORE,
+    COMBINE_DUPLICATE_SIMILARITY
+)
+from clients import get_llm
+from ratelimit import count_tokens
+from gate import (
+    QUESTION_PREFIX,
+    STOPWORDS
+)
+from tracing import (
+    span,
+    submit,
+    TokenCounter
+)
+
+"""
+Prepares the retrieved passages for the answer stage. Passages are measured with tiktoken, and near
+duplicates and passages scoring far below the best one are dropped. When the passages left fit in
+COMBINE_STUFF_TOKENS they are stuffed into the answer prompt, with long passages cut down to the
+sentences that share the most words with the question; otherwise each passage is first reduced to
+its relevant sentences by a map call, all passages in parallel, and the extracts are stuffed.
+"""
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+
+map_template = """Copy, word for word, the sentences of the following part of a document that help answer the question.
+If none of them do, reply with NONE.
+
+Document: {context}
+
+Question: {question}
+"""
+MAP_PROMPT = PromptTemplate.from_template(map_template)
+
+
+def _terms(text):
+    return {w for w in re.findall(r"[a-z0-9']+", text.casefold()) if w not in STOPWORDS}
+
+
+def _shingles(text):
+    words = re.findall(r"[a-z0-9']+", text.casefold())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+"""
+The retriever's score when it gives one (the local index does, Kendra's retrieve API does not),
+otherwise the share of the question's words found in the passage.
+"""
+def _score(doc, question_terms):
+    score = doc.metadata.get('score')
+    if isinstance(score, (int, float)):
+        return float(score)
+    return len(question_terms & _terms(doc.page_content)) / len(question_terms) if question_terms else 1.0
+
+
+"""
+Keeps the sentences of `text` sharing the most words with the question, in their original order,
+within `budget` tokens.
+"""
+def trim_passage(text, question_terms, budget):
+    sentences = [s for s in SENTENCE_SPLIT.split(text) if s.strip()]
+    ranked = sorted(range(len(sentences)), key=lambda i: (-len(question_terms & _terms(sentences[i])), i))
+    keep, used = set(), 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i], MODEL_NAME)
+        if used + tokens > budget:
+            continue
+        keep.add(i)
+        used += tokens
+    return " ".join(sentences[i] for i in sorted(keep))
+
+
+"""
+Returns the passages to answer from. `attributes` (the span's) receives the passage and token counts
+before and after, the tokens saved and the strategy: "stuff", or "map_reduce" when `adaptive` and the
+passages left after deduplication do not fit in COMBINE_STUFF_TOKENS. Those are returned untrimmed,
+for the map step to reduce.
+"""
+def select_context(docs, question, attributes, adaptive=True):
+    question = question[len(QUESTION_PREFIX):] if question.startswith(QUESTION_PREFIX) else question
+    question_terms = _terms(question)
+    tokens_in = sum(count_tokens(d.page_content, MODEL_NAME) for d in docs)
+
+    scored = sorted(((_score(d, question_terms), i, d) for i, d in enumerate(docs)), key=lambda s: (-s[0], s[1]))
+    best = scored[0][0] if scored else 0.0
+    kept, kept_shingles = [], []
+    for score, _, doc in scored:
+        if kept and score < COMBINE_MIN_SCORE * best:
+            continue
+        shingles = _shingles(doc.page_content)
+        if any(len(shingles & other) / len(shingles | other) >= COMBINE_DUPLICATE_SIMILARITY for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+
+    tokens_kept = sum(count_tokens(d.page_content, MODEL_NAME) for d in kept)
+    strategy = "map_reduce" if adaptive and tokens_kept > COMBINE_STUFF_TOKENS else "stuff"
+
+    context = []
+    for doc in kept:
+        if strategy == "map_reduce":
+            context.append(doc)
+            continue
+        content = doc.page_content
+        if count_tokens(content, MODEL_NAME) > COMBINE_PASSAGE_TOKENS:
+            content = trim_passage(content, question_terms, COMBINE_PASSAGE_TOKENS) or content
+        context.append(Document(page_content=content, metadata=doc.metadata))
+    tokens_out = sum(count_tokens(d.page_content, MODEL_NAME) for d in context)
+
+    attributes.update({
+        'passages_in': len(docs),
+        'passages_out': len(context),
+        'context_tokens_in': tokens_in,
+        'context_tokens_out': tokens_out,
+        'context_tokens_saved': tokens_in - tokens_out,
+        'strategy': strategy,
+    })
+    return context
+
+
+def _extract(doc, question):
+    with span('combine_map'):
+        extract = LLMChain(llm=get_llm(), prompt=MAP_PROMPT).run(context=doc.page_content, question=question, callbacks=[TokenCounter()])
+    extract = extract.strip()
+    return None if not extract or extract.upper().startswith("NONE") else Document(page_content=extract, metadata=doc.metadata)
+
+
+"""
+The map step of map-reduce: reduces every passage to the sentences relevant to the question, with
+one LLM call per passage, all in parallel. Passages with nothing relevant are dropped.
+"""
+def map_passages(docs, question):
+    futures = [submit(_extract, doc, question) for doc in docs]
+    return [extract for extract in (f.result() for f in futures) if extract is not None]
+
+
+"""
+Returns the passages the chain's combine step answers from. Adaptive combining only applies to stuff
+chains; the refine chain kept for the model eval gets the trimmed passages.
+"""
+def prepare_context(chain, docs, question, attributes):
+    context = select_context(docs, question, attributes, adaptive=isinstance(chain.combine_docs_chain, StuffDocumentsChain))
+    if attributes['strategy'] == "map_reduce":
+        context = map_passages(context, question)
+        attributes['context_tokens_out'] = sum(count_tokens(d.page_content, MODEL_NAME) for d in context)
+        attributes['context_tokens_saved'] = attributes['context_tokens_in'] - attributes['context_tokens_out']
+    print("---------------CONTEXT---------------:", attributes)
+    return context
+
+
+"""
+Checks the strategy selection without calling the LLM, e.g.
+    python app/combine.py check
+"""
+def check():
+    question = "How many rest days do I get?"
+    small = [Document(page_content="You get one rest day every week.", metadata={'score': 1.0})]
+    large = [
+        Document(page_content=" ".join(f"Clause {i}.{j} says worker group {i} gets rest day {j} under rule {i * 100 + j}." for j in range(120)), metadata={'score': 1.0})
+        for i in range(3)
+    ]
+
+    attributes = {}
+    select_context(small, question, attributes)
+    assert attributes['strategy'] == "stuff", attributes
+
+    attributes = {}
+    context = select_context(large, question, attributes)
+    assert attributes['context_tokens_in'] > COMBINE_STUFF_TOKENS, attributes
+    assert attributes['strategy'] == "map_reduce", attributes
+    assert [d.page_content for d in context] == [d.page_content for d in large]
+
+    attributes = {}
+    select_context(large, question, attributes, adaptive=False)
+    assert attributes['strategy'] == "stuff", attributes
+    assert attributes['context_tokens_out'] < attributes['context_tokens_in'], attributes
+    print("combine strategy check passed")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        check()
+    else:
+        print("usage: python app/combine.py check")
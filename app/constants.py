@@ -14,12 +14,76 @@ DOCUMENT = "Combined_MDW_OCR_16Jun23.pdf"
 MODEL_NAME = 'gpt-3.5-turbo'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_API_KEY2 = os.getenv('OPENAI_API_KEY2')
+OPENAI_API_KEYS = list(dict.fromkeys(k for k in [OPENAI_API_KEY, OPENAI_API_KEY2] + os.getenv('OPENAI_API_KEYS', '').split(',') if k)) # keys the OpenAI calls are spread over
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "6")) # attempts per OpenAI call, across keys
 TEMPERATURE = 0
 KENDRA_INDEX_ID = os.getenv("KENDRA_INDEX_ID")
 AWS_DEFAULT_REGION = os.getenv("AWS_DEFAULT_REGION")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 TRANSLATOR_API_KEY = os.getenv("TRANSLATOR_API_KEY")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+STREAMING = os.getenv("STREAMING", "true").lower() == "true"
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "32"))
+CONDENSE_TIMEOUT = float(os.getenv("CONDENSE_TIMEOUT", "15")) # seconds
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "15")) # seconds
+CONDENSE_GATE = os.getenv("CONDENSE_GATE", "true").lower() == "true" # skip the condense call for self-contained follow-ups
+SOURCES_HEADER = "Related Source(s):"
+GENERATED_SESSION_TEXT = "Hello! I'm your guide for migrant domestic workers. Ask me anything!"
+PAST_SESSION_TEXT = "Hey! 👋"
+WELCOME_TEXT = "How would you like us to help you today?"
+BUTTON_TEXT = "Send"
+COMBINE_STUFF_TOKENS = int(os.getenv("COMBINE_STUFF_TOKENS", "2500")) # larger contexts are map-reduced
+COMBINE_PASSAGE_TOKENS = int(os.getenv("COMBINE_PASSAGE_TOKENS", "400")) # longer passages are trimmed to their most relevant sentences
+COMBINE_MIN_SCORE = float(os.getenv("COMBINE_MIN_SCORE", "0.3")) # passages scoring below this share of the best one are dropped
+COMBINE_DUPLICATE_SIMILARITY = float(os.getenv("COMBINE_DUPLICATE_SIMILARITY", "0.8"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000")) # tokens of recent turns kept verbatim
+LOG_BACKEND = os.getenv("LOG_BACKEND", "csv") # "csv", "sqlite" or "store" (content-addressed, see logstore.py)
+LOG_DB_PATH = os.getenv("LOG_DB_PATH", "./app/prev_records/logs.sqlite3")
+LOG_STORE_DIR = os.getenv("LOG_STORE_DIR", "./app/prev_records/store")
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1")) # seconds
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_ROTATE_BYTES = int(os.getenv("LOG_ROTATE_BYTES", str(50 * 1024 * 1024))) # 0 disables size rotation
+LOG_ROTATE_SECONDS = int(os.getenv("LOG_ROTATE_SECONDS", "0")) # e.g. 86400 for daily files, 0 disables
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", "2")) # seconds
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", "20"))
+FEEDBACK_MAX_RETRIES = int(os.getenv("FEEDBACK_MAX_RETRIES", "5"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 60 * 60))) # seconds
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "./app/prev_records/answer_cache.sqlite3")
+RETRIEVAL_CACHE_BYTES = int(os.getenv("RETRIEVAL_CACHE_BYTES", str(32 * 1024 * 1024)))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", str(24 * 60 * 60))) # seconds
+INDEX_VERSION_CHECK_INTERVAL = int(os.getenv("INDEX_VERSION_CHECK_INTERVAL", "300")) # seconds
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "kendra") # "kendra", "local" or "fallback" (Kendra, local index when Kendra is slow or failing)
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "./app/static/local_index")
+LOCAL_DENSE_WEIGHT = float(os.getenv("LOCAL_DENSE_WEIGHT", "0.3")) # share of the n-gram vector score in the local ranking
+LOCAL_DOCUMENT_URL = os.getenv("LOCAL_DOCUMENT_URL") # public URL of DOCUMENT; local sources link to its pages when set
+KENDRA_FALLBACK_TIMEOUT = float(os.getenv("KENDRA_FALLBACK_TIMEOUT", "2")) # seconds
+LANG_DETECT_CONFIDENCE = float(os.getenv("LANG_DETECT_CONFIDENCE", "0.9"))
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "5000"))
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", str(7 * 24 * 60 * 60))) # seconds
+TRANSLATION_BATCH_CHARS = int(os.getenv("TRANSLATION_BATCH_CHARS", "1500")) # sentences sent per translation request
+STATIC_TRANSLATIONS_PATH = os.getenv("STATIC_TRANSLATIONS_PATH", "./app/static/translations.json") # pretranslated fixed texts
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1")) # processes sharing the port
+SERVER_TURN_WORKERS = int(os.getenv("SERVER_TURN_WORKERS", "64")) # turns running at once per process
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", str(24 * 60 * 60))) # seconds
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "100000"))
+CHAT_API_URL = os.getenv("CHAT_API_URL") # when set, main.py is a client of the API served by server.py
+CHAT_API_TIMEOUT = float(os.getenv("CHAT_API_TIMEOUT", "120")) # seconds
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite") # "sqlite", "redis" or "none"
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "./app/prev_records/sessions.sqlite3")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 60 * 60))) # seconds after the last turn
+TURN_LOCK_TTL = int(os.getenv("TURN_LOCK_TTL", "300")) # seconds a turn holds its conversation's lock at most, if its process dies
+FAQ_INDEX_PATH = os.getenv("FAQ_INDEX_PATH", "./app/static/faq_index.json")
+FAQ_REVIEW_PATH = os.getenv("FAQ_REVIEW_PATH", "./app/prev_records/faq_review.csv")
+FAQ_LANGUAGES = os.getenv("FAQ_LANGUAGES", "tl,id,my,ta,bn,hi,si,km,zh-CN").split(",") # languages FAQ answers and fixed texts are pre-translated into, besides English
+FAQ_TOP_CLUSTERS = int(os.getenv("FAQ_TOP_CLUSTERS", "100"))
+FAQ_MIN_COUNT = int(os.getenv("FAQ_MIN_COUNT", "3")) # times a question cluster must have been asked
+FAQ_CLUSTER_SIMILARITY = float(os.getenv("FAQ_CLUSTER_SIMILARITY", "0.85"))
 
 # # Commented out to run locally
 # AWS_DEFAULT_REGION == st.secrets["AWS_DEFAULT_REGION"]
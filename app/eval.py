@@ -1,15 +1,18 @@
 from langchain.evaluation import load_evaluator
-from langchain.chat_models import ChatOpenAI
 from langchain.evaluation.criteria.eval_chain import Criteria
 from colorama import Fore
 from enum import Enum
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pytz
 import csv
-import time
+import hashlib
+import json
+import os
+import re
 from langchain.prompts import PromptTemplate
-from bert_score import score
 import logging
+import sys
 import transformers
 
 transformers.tokenization_utils.logger.setLevel(logging.ERROR)
@@ -17,13 +20,34 @@ transformers.configuration_utils.logger.setLevel(logging.ERROR)
 transformers.modeling_utils.logger.setLevel(logging.ERROR)
 
 # local modules
-from constants import (
-    MODEL_NAME,
-    OPENAI_API_KEY,
-    TEMPERATURE,
+from constants import MODEL_NAME
+from clients import (
+    get_key_pool,
+    get_llm
 )
+from ratelimit import (
+    RateLimiter,
+    count_tokens
+)
+from bertscore import score_pairs
+from tracing import load_latencies
+from cache import normalize_question
 
 EVAL_EXCEL_NAME = "9Nov_LaunchPadGPT4" #[TODO] Update the column name to be evaluated
+INPUT_PATH = './app/prev_records/labeled_criteria_pre.csv' # [TODO] Update the sheet to extract the questions / reference / response
+OUTPUT_PATH = './app/prev_records/labeled_criteria_post.csv'
+CHECKPOINT_PATH = './app/prev_records/labeled_criteria_checkpoint.jsonl' # rows already evaluated, so an interrupted run resumes
+CALIBRATION_PATH = './app/prev_records/labeled_criteria_calibration.csv'
+
+# "per_criterion" makes one LLM call per criterion; "combined" grades all criteria of a row in one
+# call, cheaper but only to be used once `python app/eval.py calibrate` shows it agrees
+GRADING_MODE = os.getenv("EVAL_GRADING_MODE", "per_criterion")
+
+# Criterion calls run concurrently, within the OpenAI limits of each pooled API key
+MAX_WORKERS = int(os.getenv("EVAL_MAX_WORKERS", "6"))
+REQUESTS_PER_MINUTE = int(os.getenv("EVAL_REQUESTS_PER_MINUTE", "60"))
+TOKENS_PER_MINUTE = int(os.getenv("EVAL_TOKENS_PER_MINUTE", "60000"))
+COMPLETION_TOKENS = 400 # expected length of an explanation and score, counted against the token budget
 
 prompt_template = PromptTemplate(
         template = """
@@ -45,12 +69,8 @@ prompt_template = PromptTemplate(
         input_variables = ["criteria", "reference", "input", "output"]
 )
 
-llm = ChatOpenAI(
-        temperature=TEMPERATURE,
-        model_name=MODEL_NAME,
-        openai_api_key=OPENAI_API_KEY,
-        verbose=True
-    )
+# Calls are spread over the keys of the pool, see llm_pool.py
+llm = get_llm()
 
 guideQn_Simplicity = "\
     1. Is the response clear and easy to understand for individuals with lower literacy levels? \
@@ -115,77 +135,312 @@ custom_criteria = [
     """},
 ]
 
-with open('./app/prev_records/labeled_criteria_pre.csv', mode='r', encoding= 'unicode_escape') as csv_file: # [TODO] Update the sheet to extract the questions / reference / response
-    csv_reader = csv.DictReader(csv_file, delimiter=",")
-    line_count = 0
+combined_prompt_template = PromptTemplate(
+        template = """
+            You are to evaluate answers to queries from migrant domestic workers in Singapore.
 
-    for row in csv_reader:
-        # line_count+=1
-        # if line_count<16:
-        #     continue
+            Grade the following response on each criterion below with an integer score of 1 (worst) to 3 (best), based on how well it follows that criterion's rubric.
+            Grade only based on the rubrics and expected response:
 
-        criteria_results = []
+            {criteria}
 
-        # Criteria 1-6 - Simplicity, Empathy, Correctness, Detail, Maliciousness, Coherence
-        for i in custom_criteria:
-            evaluator = load_evaluator("labeled_criteria", llm=llm, criteria=i, prompt=prompt_template, requires_reference=True)
-
-            output = evaluator.evaluate_strings(
-                input = str(row["Question"]),
-                prediction = str(row[EVAL_EXCEL_NAME]), 
-                reference = str(row["Reference"]),
-            )
-            cname = str(list(i.keys())[0])
-            criteria_results.append([cname, output])
-            print(Fore.BLUE + f"" + str(output) + "\n")
+            Expected Response: {reference}
 
-            time.sleep(20)
+            DATA:
+            ---------
+            Question: {input}
+            Response: {output}
+            ---------
+            Respond only with a JSON object with one key per criterion ({names}), each holding an object with
+            "reasoning" (your explanation for that criterion) and "score" (the integer score), e.g.
+            {{"Simplicity": {{"reasoning": "...", "score": 2}}, ...}}
+        """,
+        input_variables = ["criteria", "reference", "input", "output", "names"]
+)
 
-        # Criteria 7 - Performance (Latency)
-        actual_perfomance = int(row[EVAL_EXCEL_NAME+"_Performance"]) 
-        performance_grade = 0
-        if actual_perfomance >= 2300:
-            performance_grade = 1
-        elif actual_perfomance <= 400:
-            performance_grade = 3
-        else:
-            performance_grade = 2
-
-        # Criteria 8 - BERTScore
-        BERTScore_grade = 0
-        P, R, F1 = score([row[EVAL_EXCEL_NAME]], 
-                         [row["Reference"]], 
-                         lang='en', 
-                         verbose=True)
-        if F1 <= 0.6:
-            BERTScore_grade = 1
-        elif F1 >= 0.7:
-            BERTScore_grade = 3
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE * len(get_key_pool().keys), TOKENS_PER_MINUTE * len(get_key_pool().keys))
+
+
+def criterion_name(criterion):
+    return str(list(criterion.keys())[0])
+
+
+def row_key(row):
+    return hashlib.sha256(json.dumps([EVAL_EXCEL_NAME, row["Question"], row["Reference"], row[EVAL_EXCEL_NAME]]).encode()).hexdigest()
+
+
+def load_checkpoint():
+    if not os.path.exists(CHECKPOINT_PATH):
+        return set()
+    with open(CHECKPOINT_PATH) as f:
+        return {json.loads(line)["key"] for line in f if line.strip()}
+
+
+def save_checkpoint(key):
+    with open(CHECKPOINT_PATH, 'a') as f:
+        f.write(json.dumps({"key": key}) + "\n")
+
+
+def evaluate_criterion(row, criterion):
+    prompt = prompt_template.format(
+        criteria=str(criterion),
+        reference=str(row["Reference"]),
+        input=str(row["Question"]),
+        output=str(row[EVAL_EXCEL_NAME])
+    )
+    rate_limiter.acquire(count_tokens(prompt, MODEL_NAME) + COMPLETION_TOKENS)
+
+    evaluator = load_evaluator("labeled_criteria", llm=llm, criteria=criterion, prompt=prompt_template, requires_reference=True)
+    output = evaluator.evaluate_strings(
+        input = str(row["Question"]),
+        prediction = str(row[EVAL_EXCEL_NAME]), 
+        reference = str(row["Reference"]),
+    )
+    print(Fore.BLUE + f"" + str(output) + "\n")
+    return output
+
+
+"""
+Reads the 1-3 score of a criterion from a grader output, or None if there is none.
+"""
+def score_of(output):
+    for value in [output.get("score"), output.get("value")]:
+        try:
+            if int(value) in (1, 2, 3):
+                return int(value)
+        except (TypeError, ValueError):
+            pass
+    found = re.findall(r"\b([123])\b", str(output.get("reasoning", "")).strip().split("\n")[-1])
+    return int(found[-1]) if found else None
+
+
+"""
+Parses the combined grading response into {criterion: output}, with each output shaped like the
+labeled_criteria evaluator's (reasoning, value, score). Criteria whose score cannot be read are left
+out, so the caller can grade them separately.
+"""
+def parse_combined(text):
+    names = [criterion_name(c) for c in custom_criteria]
+    parsed = {}
+
+    match = re.search(r"\{.*\}", text, re.S)
+    data = {}
+    if match:
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            data = {}
+    data = {str(k).strip().lower(): v for k, v in data.items()} if isinstance(data, dict) else {}
+
+    for name in names:
+        entry = data.get(name.lower())
+        reasoning = ""
+        if isinstance(entry, dict):
+            reasoning = str(entry.get("reasoning", ""))
+            entry = entry.get("score")
+        score = score_of({"score": entry})
+
+        if score is None:
+            # Not valid JSON for this criterion: look for e.g. "Empathy ... score: 2" in the text
+            found = re.search(name + r"\W[^\n]*?score\W{0,4}([123])\b", text, re.I)
+            score = int(found.group(1)) if found else None
+
+        if score is not None:
+            parsed[name] = {"reasoning": reasoning, "value": str(score), "score": score}
+    return parsed
+
+
+"""
+Grades all criteria of a row in one LLM call. Only the criteria that fail to parse are graded again,
+one call each, with the per-criterion evaluator.
+"""
+def evaluate_row_combined(row):
+    prompt = combined_prompt_template.format(
+        criteria="\n\n".join(str(c) for c in custom_criteria),
+        names=", ".join(criterion_name(c) for c in custom_criteria),
+        reference=str(row["Reference"]),
+        input=str(row["Question"]),
+        output=str(row[EVAL_EXCEL_NAME])
+    )
+    rate_limiter.acquire(count_tokens(prompt, MODEL_NAME) + COMPLETION_TOKENS * 2)
+    parsed = parse_combined(llm.predict(prompt))
+
+    results = []
+    for c, criterion in enumerate(custom_criteria):
+        output = parsed.get(criterion_name(criterion))
+        if output is None:
+            print(Fore.YELLOW + f"Falling back to a separate call for {criterion_name(criterion)}")
+            output = evaluate_criterion(row, criterion)
         else:
-            BERTScore_grade = 2
-        print("Precision: " + str(P), "\n", "Recall: " + str(R), "\n", "F1: " + str(F1))
-
-        # Recording log in labeled_criteria_post.csv
-        now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
-        data = [now,
-                EVAL_EXCEL_NAME, 
-                row["Question"], 
-                row["Reference"], 
-                row[EVAL_EXCEL_NAME]] 
-        
-        for i in criteria_results:
-            data.append(i[0])
-            print("\n" + Fore.BLUE + f"" + "criteria: " + str(i[0]))
-            for j in i[1]:
-                if i[1][j] is not None:
-                    print(Fore.BLUE + f"" + j + "-" + str(i[1][j]))
-                    data.append(i[1][j])
-        
-        data.append(actual_perfomance)
-        data.append(performance_grade)
-        data.append([P,R,F1])
-        data.append(BERTScore_grade)
-
-        with open('./app/prev_records/labeled_criteria_post.csv', mode='a') as f:
-            writer = csv.writer(f)
-            writer.writerow(data)
\ No newline at end of file
+            print(Fore.BLUE + f"" + str(output) + "\n")
+        results.append((c, output))
+    return results
+
+
+def evaluate_row_per_criterion(row, c):
+    return [(c, evaluate_criterion(row, custom_criteria[c]))]
+
+
+"""
+Grades latency and BERTScore for a row whose criteria have been evaluated, and builds its
+labeled_criteria_post.csv record.
+"""
+def build_record(row, criteria_results, bert_score, latencies):
+    # Criteria 7 - Performance (Latency), from the sheet or else from the app's latency log
+    actual_perfomance = str(row.get(EVAL_EXCEL_NAME+"_Performance") or "").strip()
+    actual_perfomance = int(actual_perfomance) if actual_perfomance else latencies.get(normalize_question(row["Question"]))
+    performance_grade = 0
+    if actual_perfomance is None:
+        print(Fore.RED + "No latency recorded for: " + row["Question"])
+    elif actual_perfomance >= 2300:
+        performance_grade = 1
+    elif actual_perfomance <= 400:
+        performance_grade = 3
+    else:
+        performance_grade = 2
+
+    # Criteria 8 - BERTScore
+    BERTScore_grade = 0
+    P, R, F1 = bert_score
+    if F1 <= 0.6:
+        BERTScore_grade = 1
+    elif F1 >= 0.7:
+        BERTScore_grade = 3
+    else:
+        BERTScore_grade = 2
+    print("Precision: " + str(P), "\n", "Recall: " + str(R), "\n", "F1: " + str(F1))
+
+    # Recording log in labeled_criteria_post.csv
+    now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
+    data = [now,
+            EVAL_EXCEL_NAME, 
+            row["Question"], 
+            row["Reference"], 
+            row[EVAL_EXCEL_NAME]] 
+    
+    for i in criteria_results:
+        data.append(i[0])
+        print("\n" + Fore.BLUE + f"" + "criteria: " + str(i[0]))
+        for j in i[1]:
+            if i[1][j] is not None:
+                print(Fore.BLUE + f"" + j + "-" + str(i[1][j]))
+                data.append(i[1][j])
+    
+    data.append(actual_perfomance)
+    data.append(performance_grade)
+    data.append([P,R,F1])
+    data.append(BERTScore_grade)
+    return data
+
+
+"""
+Evaluates every row of INPUT_PATH that is not in the checkpoint yet. The grading calls of all rows
+(one per row in the combined mode, one per criterion otherwise) are scheduled on a thread pool and
+paced by the rate limiter; each row is written to OUTPUT_PATH and checkpointed as soon as its last
+criterion completes, so rows may be written out of order.
+"""
+def run():
+    done = load_checkpoint()
+    with open(INPUT_PATH, mode='r', encoding= 'unicode_escape') as csv_file:
+        rows = [row for row in csv.DictReader(csv_file, delimiter=",") if row_key(row) not in done]
+    print(Fore.BLUE + f"{len(done)} rows already evaluated, {len(rows)} to go")
+
+    # Criteria 8 - BERTScore, for all rows in one batched pass
+    bert_scores = score_pairs([row[EVAL_EXCEL_NAME] for row in rows], [row["Reference"] for row in rows])
+    latencies = load_latencies()
+
+    results = {i: [None] * len(custom_criteria) for i in range(len(rows))}
+    remaining = {i: len(custom_criteria) for i in range(len(rows))}
+    failed = set()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Criteria 1-6 - Simplicity, Empathy, Correctness, Detail, Maliciousness, Coherence
+        futures = {}
+        for i, row in enumerate(rows):
+            if GRADING_MODE == "combined":
+                futures[executor.submit(evaluate_row_combined, row)] = (i, range(len(custom_criteria)))
+            else:
+                for c in range(len(custom_criteria)):
+                    futures[executor.submit(evaluate_row_per_criterion, row, c)] = (i, [c])
+
+        for future in as_completed(futures):
+            i, criteria = futures[future]
+            remaining[i] -= len(criteria)
+            try:
+                for c, output in future.result():
+                    results[i][c] = [criterion_name(custom_criteria[c]), output]
+            except Exception as e:
+                # The row is not checkpointed, so the next run retries it
+                print(Fore.RED + f"Row {i} failed: {e}")
+                failed.add(i)
+            if remaining[i] or i in failed:
+                continue
+
+            data = build_record(rows[i], results.pop(i), bert_scores[i], latencies)
+            with open(OUTPUT_PATH, mode='a') as f:
+                writer = csv.writer(f)
+                writer.writerow(data)
+            save_checkpoint(row_key(rows[i]))
+
+    for label, stats in get_key_pool().stats().items():
+        print(Fore.BLUE + f"{label}: {stats['calls']} calls, {stats['throttled']} throttled, {stats['errors']} errors")
+
+
+"""
+Compares the BERTScore of several response columns of INPUT_PATH against the reference, e.g.
+    python app/eval.py bertscore 9Nov_LaunchPadGPT4 9Nov_LaunchPadGPT35
+"""
+def compare_bertscore(column_names):
+    with open(INPUT_PATH, mode='r', encoding= 'unicode_escape') as csv_file:
+        rows = list(csv.DictReader(csv_file, delimiter=","))
+
+    for name in column_names:
+        scores = score_pairs([row[name] for row in rows], [row["Reference"] for row in rows])
+        n = len(scores) or 1
+        P, R, F1 = (sum(s[k] for s in scores) / n for k in range(3))
+        print(Fore.BLUE + f"{name}: Precision {P:.4f} Recall {R:.4f} F1 {F1:.4f} ({len(scores)} rows)")
+
+
+"""
+Grades the first `limit` rows of INPUT_PATH in both modes and reports, per criterion, how often the
+combined mode agrees with the per-criterion mode, e.g.
+    python app/eval.py calibrate 20
+Per-row scores are written to CALIBRATION_PATH.
+"""
+def calibrate(limit=20):
+    with open(INPUT_PATH, mode='r', encoding= 'unicode_escape') as csv_file:
+        rows = list(csv.DictReader(csv_file, delimiter=","))[:limit]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        combined = list(executor.map(evaluate_row_combined, rows))
+        per_criterion = list(executor.map(lambda row: [(c, evaluate_criterion(row, criterion)) for c, criterion in enumerate(custom_criteria)], rows))
+
+    header = ["Question", "Criteria", "Combined_Score", "Per_Criterion_Score"]
+    pairs = {criterion_name(c): [] for c in custom_criteria}
+    with open(CALIBRATION_PATH, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row, row_combined, row_separate in zip(rows, combined, per_criterion):
+            for (c, a), (_, b) in zip(row_combined, row_separate):
+                name = criterion_name(custom_criteria[c])
+                pairs[name].append((score_of(a), score_of(b)))
+                writer.writerow([row["Question"], name, score_of(a), score_of(b)])
+
+    for name, scores in pairs.items():
+        scores = [(a, b) for a, b in scores if a is not None and b is not None]
+        if not scores:
+            print(Fore.RED + f"{name}: no comparable scores")
+            continue
+        agreement = sum(a == b for a, b in scores) / len(scores)
+        mean_diff = sum(abs(a - b) for a, b in scores) / len(scores)
+        bias = sum(a - b for a, b in scores) / len(scores)
+        print(Fore.BLUE + f"{name}: agreement {agreement:.0%}, mean abs difference {mean_diff:.2f}, combined - per criterion {bias:+.2f} ({len(scores)} rows)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "bertscore":
+        compare_bertscore(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "calibrate":
+        calibrate(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    else:
+        run()
@@ -0,0 +1,198 @@
+# standard library modules
+import csv
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
+
+# third-party modules
+import numpy as np
+
+# local modules
+from constants import (
+    FAQ_INDEX_PATH,
+    FAQ_REVIEW_PATH,
+    FAQ_LANGUAGES,
+    FAQ_TOP_CLUSTERS,
+    FAQ_MIN_COUNT,
+    FAQ_CLUSTER_SIMILARITY
+)
+from clients import get_or_create
+from cache import normalize_question
+from gate import QUESTION_PREFIX
+from local_retriever import hashed_vector
+from logsink import read_log
+
+"""
+Pre-generated answers to the most common questions, in every supported language.
+
+An offline job mines the question clusters from the logs, answers each cluster once with the chain
+and translates the answer into FAQ_LANGUAGES. The answers are written to FAQ_REVIEW_PATH, where they
+are vetted by setting Approved to "yes", and only approved answers are built into the lookup index
+that respond() checks before calling the chain.
+    python app/faq.py mine     # writes FAQ_REVIEW_PATH, keeping earlier approvals
+    python app/faq.py build    # writes FAQ_INDEX_PATH from the approved rows
+"""
+
+QNA_PATH = "./app/prev_records/qna.csv"
+LATENCY_PATH = "./app/prev_records/latency.csv"
+
+# Query ids of FAQ answers start with this prefix, so their feedback is never sent to Kendra
+FAQ_QUERY_PREFIX = "faq-"
+
+REVIEW_HEADER = ["Entry", "Count", "Question", "Variants", "Language", "Answer", "Approved"]
+
+
+def _strip_prefix(question):
+    return question[len(QUESTION_PREFIX):] if question.startswith(QUESTION_PREFIX) else question
+
+
+"""
+The lookup index: normalised question variants (English and as typed in other languages) mapped to
+an entry, and per entry its English question and approved answers by language.
+"""
+class FaqIndex:
+    def __init__(self, path=FAQ_INDEX_PATH):
+        self.questions = {}
+        self.entries = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                index = json.load(f)
+            self.questions = index['questions']
+            self.entries = index['entries']
+        except FileNotFoundError:
+            pass
+
+    def __bool__(self):
+        return bool(self.questions)
+
+    """
+    Returns (entry, answer in `lang`) for a question matching an entry with an approved answer in
+    `lang`, or (None, None).
+    """
+    def lookup(self, question, lang):
+        entry = self.questions.get(normalize_question(_strip_prefix(question)))
+        answer = self.entries.get(entry, {}).get('answers', {}).get(lang)
+        return (entry, answer) if answer else (None, None)
+
+
+def get_faq_index():
+    return get_or_create('faq_index', lambda: FaqIndex(FAQ_INDEX_PATH))
+
+
+def _read_csv(path):
+    try:
+        with open(path, encoding='utf-8', newline='') as f:
+            return list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+
+
+"""
+Groups the logged questions into clusters of near-identical wording (cosine similarity of hashed
+character n-gram vectors), most asked first. Returns [(representative question, count, variants)].
+"""
+def cluster_questions(rows):
+    counts = Counter()
+    for row in rows:
+        if "do not have the answer to your question" in row['Answer']:
+            continue
+        question = _strip_prefix(row['Generated Question'] or row['Original Question'])
+        if normalize_question(question):
+            counts[normalize_question(question)] += 1
+
+    clusters = [] # [[representative, count, variants]]
+    vectors = np.zeros((0, 0), dtype=np.float32)
+    for question, count in counts.most_common():
+        vector = hashed_vector(question)
+        similarities = vectors @ vector if len(clusters) else np.zeros(0)
+        if len(similarities) and similarities.max() >= FAQ_CLUSTER_SIMILARITY:
+            cluster = clusters[int(similarities.argmax())]
+            cluster[1] += count
+            cluster[2].append(question)
+        else:
+            clusters.append([question, count, [question]])
+            vectors = np.vstack([vectors, vector]) if len(vectors) else vector[None, :]
+
+    clusters.sort(key=lambda c: -c[1])
+    return [tuple(c) for c in clusters if c[1] >= FAQ_MIN_COUNT][:FAQ_TOP_CLUSTERS]
+
+
+"""
+Adds the questions as users typed them in their own language, from LATENCY_PATH, to the variants of
+the cluster their English translation belongs to.
+"""
+def _native_variants(clusters):
+    cluster_of = {v: i for i, (_, _, variants) in enumerate(clusters) for v in variants}
+    natives = [set() for _ in clusters]
+    for row in read_log(LATENCY_PATH):
+        i = cluster_of.get(normalize_question(_strip_prefix(row['Question'])))
+        if i is not None and row['Original_Question']:
+            natives[i].add(normalize_question(row['Original_Question']))
+    return natives
+
+
+def mine():
+    # The chain is only needed by this offline job; function.py imports this module for the lookup
+    from function import (
+        start_conversation,
+        helpline_text,
+        answer_with_sources
+    )
+    from pipeline import run_turn
+    from translation import translate_output
+
+    approved = {(r['Entry'], r['Language'], r['Answer']) for r in _read_csv(FAQ_REVIEW_PATH) if r['Approved'].strip().lower() == "yes"}
+    clusters = cluster_questions(read_log(QNA_PATH))
+    natives = _native_variants(clusters)
+    chain = start_conversation()
+
+    rows = []
+    for (question, count, variants), native in zip(clusters, natives):
+        entry = hashlib.sha1(question.encode()).hexdigest()[:12]
+        result = run_turn(chain, QUESTION_PREFIX + question, [], inputs={"helpline_text": helpline_text})
+        output, _ = answer_with_sources(result)
+        output = output.replace("$", "SGD")
+        for lang in ['en'] + [l for l in FAQ_LANGUAGES if l != 'en']:
+            answer = translate_output(output, lang)
+            rows.append([entry, count, question, json.dumps(sorted(set(variants) | native), ensure_ascii=False), lang, answer, "yes" if (entry, lang, answer) in approved else "no"])
+        print(f"{count:>6}  {question}")
+
+    os.makedirs(os.path.dirname(FAQ_REVIEW_PATH), exist_ok=True)
+    with open(FAQ_REVIEW_PATH, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REVIEW_HEADER)
+        writer.writerows(rows)
+    print(f"Wrote {len(clusters)} clusters to {FAQ_REVIEW_PATH}; set Approved to \"yes\" on vetted answers and run `python app/faq.py build`")
+
+
+"""
+Builds the lookup index from the approved rows of the review sheet. An entry is only served when its
+English answer is approved, as that is the answer kept in the chat history.
+"""
+def build():
+    questions, entries = {}, {}
+    for row in _read_csv(FAQ_REVIEW_PATH):
+        if row['Approved'].strip().lower() != "yes":
+            continue
+        entry = entries.setdefault(row['Entry'], {'question': row['Question'], 'answers': {}})
+        entry['answers'][row['Language']] = row['Answer']
+        for variant in json.loads(row['Variants']):
+            questions[variant] = row['Entry']
+
+    entries = {e: entry for e, entry in entries.items() if 'en' in entry['answers']}
+    questions = {q: e for q, e in questions.items() if e in entries}
+    os.makedirs(os.path.dirname(FAQ_INDEX_PATH) or '.', exist_ok=True)
+    with open(FAQ_INDEX_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'questions': questions, 'entries': entries}, f, ensure_ascii=False, separators=(',', ':'))
+    print(f"Indexed {len(entries)} entries, {len(questions)} question variants into {FAQ_INDEX_PATH}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "mine":
+        mine()
+    elif len(sys.argv) > 1 and sys.argv[1] == "build":
+        build()
+    else:
+        print("usage: python app/faq.py mine | build")
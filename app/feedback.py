@@ -0,0 +1,192 @@
+# standard library modules
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+# third-party modules
+import pytz
+from botocore.exceptions import ClientError
+from cachetools import LRUCache
+
+# local modules
+from constants import (
+    KENDRA_INDEX_ID,
+    FEEDBACK_FLUSH_INTERVAL,
+    FEEDBACK_BATCH_SIZE,
+    FEEDBACK_MAX_RETRIES
+)
+from clients import (
+    get_or_create,
+    get_kendra_client,
+    override
+)
+from logsink import get_log_sink
+from local_retriever import LOCAL_QUERY_PREFIX
+from faq import FAQ_QUERY_PREFIX
+
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+
+"""
+Collects 👍/👎 clicks and submits them to Kendra from a background thread.
+
+Clicks are accepted instantly and every click is written to feedback.csv. Pending feedback is
+coalesced per QueryId (one submit_feedback call carries every result of a query). Only the Kendra
+call is deduplicated, per click: `click_key` names the message clicked on (e.g. the conversation and
+message index), so clicking the same button again is not resubmitted, while other users voting on the
+same QueryId (FAQ answers and cached answers share them) are. Each flush submits up to `batch_size`
+queries; throttled calls are retried with exponential backoff.
+"""
+class FeedbackQueue:
+    def __init__(self, client, index_id, flush_interval=2.0, batch_size=20, max_retries=5):
+        self.client = client
+        self.index_id = index_id
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._pending = {} # QueryId -> [(click_key, [ResultId], RelevanceValue)]
+        self._submitted = LRUCache(maxsize=100000) # (click_key, QueryId, ResultId) -> RelevanceValue
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='kendra-feedback', daemon=True)
+        self._thread.start()
+
+    def submit(self, queryid, resultids, relevance_value, click_key=None):
+        with self._lock:
+            self._pending.setdefault(queryid, []).append((click_key, list(resultids), relevance_value))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            queryids = list(self._pending)[:self.batch_size]
+            batch = {q: self._pending.pop(q) for q in queryids}
+
+        for queryid, clicks in batch.items():
+            self._submit_query(queryid, clicks)
+
+        if self._pending:
+            self._wakeup.set()
+
+    # The results of each click still to be sent to Kendra; a click without a key is always sent
+    def _unsent(self, queryid, clicks):
+        unsent, seen = [], set()
+        with self._lock:
+            for click_key, resultids, value in clicks:
+                new = []
+                for resultid in resultids:
+                    key = (click_key, queryid, resultid)
+                    if click_key is None or (self._submitted.get(key) != value and (key, value) not in seen):
+                        new.append(resultid)
+                        seen.add((key, value))
+                unsent.append(new)
+        return unsent
+
+    def _submit_query(self, queryid, clicks):
+        unsent = self._unsent(queryid, clicks)
+        items = {}
+        for (_, _, value), resultids in zip(clicks, unsent):
+            for resultid in resultids:
+                items[resultid] = value
+
+        relevance_items = [{"ResultId": r, "RelevanceValue": v} for r, v in items.items()]
+        # Results of the local index and FAQ answers are unknown to Kendra; their feedback is only logged
+        response = "not submitted" if queryid.startswith((LOCAL_QUERY_PREFIX, FAQ_QUERY_PREFIX)) else None
+        failed = False
+        for attempt in range(self.max_retries + 1 if response is None and items else 0):
+            try:
+                response = self.client.submit_feedback(
+                    QueryId = queryid,
+                    IndexId = self.index_id,
+                    RelevanceFeedbackItems = relevance_items
+                )
+                break
+            except Exception as e:
+                throttled = isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+                if not throttled or attempt == self.max_retries:
+                    print("------------FEEDBACK ERROR-----------:", queryid, e)
+                    response = str(e)
+                    failed = True
+                    break
+                time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+        # A failed submit is not remembered, so clicking again sends it again
+        if not failed:
+            with self._lock:
+                for (click_key, _, value), resultids in zip(clicks, unsent):
+                    for resultid in resultids:
+                        if click_key is not None:
+                            self._submitted[(click_key, queryid, resultid)] = value
+
+        # Write to CSVs, one row per click
+        header = ["Time_Enquired", "QueryId", "ResultIds", "Status", "Feedback"]
+        now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
+        for (_, resultids, value), new in zip(clicks, unsent):
+            data = [now, queryid, resultids, value, response if new else "already submitted"]
+            get_log_sink().write("./app/prev_records/feedback.csv", header, data)
+
+
+def get_feedback_queue():
+    return get_or_create('feedback_queue', lambda: FeedbackQueue(
+        get_kendra_client(),
+        KENDRA_INDEX_ID,
+        flush_interval=FEEDBACK_FLUSH_INTERVAL,
+        batch_size=FEEDBACK_BATCH_SIZE,
+        max_retries=FEEDBACK_MAX_RETRIES
+    ))
+
+
+"""
+Checks that every click is logged and that only repeated clicks on the same message skip Kendra:
+    python app/feedback.py check
+"""
+def check():
+    class Client:
+        def __init__(self):
+            self.calls = []
+
+        def submit_feedback(self, **kwargs):
+            self.calls.append(kwargs)
+            return {}
+
+    class Sink:
+        def __init__(self):
+            self.rows = []
+
+        def write(self, file_path, header, row):
+            self.rows.append(row)
+
+    client, sink = Client(), Sink()
+    override('log_sink', sink)
+    feedback_queue = FeedbackQueue(client, "index", flush_interval=3600)
+
+    # two sessions voting on the same FAQ answer are both logged
+    faq_queryid = FAQ_QUERY_PREFIX + "rest-days"
+    feedback_queue.submit(faq_queryid, ["r1"], "RELEVANT", click_key="session-a:1")
+    feedback_queue.submit(faq_queryid, ["r1"], "RELEVANT", click_key="session-b:1")
+    feedback_queue._flush()
+    assert [row[1] for row in sink.rows] == [faq_queryid, faq_queryid], sink.rows
+    assert not client.calls, client.calls
+
+    # a cached Kendra answer: a second session's vote is submitted, a repeated click is only logged
+    feedback_queue.submit("q1", ["r1"], "RELEVANT", click_key="session-a:2")
+    feedback_queue._flush()
+    feedback_queue.submit("q1", ["r1"], "RELEVANT", click_key="session-b:4")
+    feedback_queue.submit("q1", ["r1"], "RELEVANT", click_key="session-a:2")
+    feedback_queue._flush()
+    assert len(client.calls) == 2, client.calls
+    assert len(sink.rows) == 5, sink.rows
+    assert sink.rows[-1][-1] == "already submitted", sink.rows[-1]
+    print("feedback check passed")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        check()
+    else:
+        print("usage: python app/feedback.py check")
@@ -2,30 +2,62 @@
 import os
 import re
 import pprint
-import csv
 import pytz
 from datetime import datetime
 
 # third-party modules
-import boto3
 import streamlit as st
 
 from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models import ChatOpenAI
-from langchain.retrievers import AmazonKendraRetriever
+from langchain.chains.combine_documents.refine import RefineDocumentsChain
 from langchain.prompts import PromptTemplate
+from langchain.schema import Document
 from enum import Enum
 
 # local modules
 from constants import (
-    MODEL_NAME,
-    OPENAI_API_KEY,
-    KENDRA_INDEX_ID,
-    TEMPERATURE,
-    AWS_DEFAULT_REGION
+    SOURCES_HEADER,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_PATH
 )
-
-kendra = boto3.client('kendra')
+from clients import (
+    get_or_create,
+    get_llm
+)
+from cache import (
+    Cache,
+    normalize_question
+)
+from retriever import (
+    get_retriever,
+    get_index_version
+)
+from pipeline import run_turn
+from logsink import get_log_sink
+from feedback import get_feedback_queue
+from tracing import (
+    start_trace,
+    finish_trace,
+    span,
+    mark
+)
+from translation import (
+    detect_language,
+    translate,
+    translate_output
+)
+from streaming import StreamHandler
+from gate import (
+    QUESTION_PREFIX,
+    needs_rephrase
+)
+from faq import (
+    FAQ_QUERY_PREFIX,
+    get_faq_index
+)
+from session_store import record_turn
+from singleflight import Group
 
 # Build prompt
 condense_template = """Given the following conversation and a follow up question, if they are of the same topic,
@@ -95,49 +127,50 @@ class Chain_Type(Enum):
     STUFF = 1
     REFINE = 2
 
-currChain_Type = ""
-### -----------------------------end MODEL EVAL-----------------------------###
 
-def start_conversation():
+"""
+Returns the name of the chain type used by a chain, for the model eval logs.
+"""
+def chain_type_of(chain):
+    if isinstance(chain.combine_docs_chain, RefineDocumentsChain):
+        return Chain_Type.REFINE.name
+    return Chain_Type.STUFF.name
+### -----------------------------end MODEL EVAL-----------------------------###
 
-    retriever = AmazonKendraRetriever(index_id=KENDRA_INDEX_ID, top_k=3, region=AWS_DEFAULT_REGION)
-    llm=ChatOpenAI(
-            temperature=TEMPERATURE,
-            model_name=MODEL_NAME,
-            openai_api_key=OPENAI_API_KEY,
-            verbose=True
-        )
+def _build_chain(streaming=False):
+    retriever = get_retriever(top_k=3)
 
     chain = ConversationalRetrievalChain.from_llm(
         combine_docs_chain_kwargs = {'prompt': QA_CHAIN_PROMPT},
-        llm=llm,
+        llm=get_llm(streaming=streaming),
+        condense_question_llm=get_llm(), # Only the answer is streamed to the user
         retriever=retriever,
         condense_question_prompt=CONDENSE_QUESTION_PROMPT,
         return_source_documents = True,
         return_generated_question = True,
         rephrase_question = False, # Does not return condensed question to LLM, only uses it for retrieval
         verbose=True)
-    
-    global currChain_Type 
-    currChain_Type = Chain_Type.STUFF.name
+
     return chain
 
+"""
+The chains hold no conversation state (the chat history is passed in on every call), so a single
+instance per chain type is shared by every session and every rerun.
+"""
+def start_conversation(streaming=False):
+    if streaming:
+        return get_or_create(Chain_Type.STUFF.name + "_STREAMING", lambda: _build_chain(streaming=True))
+    return get_or_create(Chain_Type.STUFF.name, _build_chain)
+
 ### ------------------------------------------------------------------------###
 ### -----------------------------for MODEL EVAL-----------------------------###
 ### ------------------------------------------------------------------------###
-def start_conversation_refine():
-
-    retriever = AmazonKendraRetriever(index_id=KENDRA_INDEX_ID, top_k=3, region=AWS_DEFAULT_REGION)
-    llm=ChatOpenAI(
-            temperature=TEMPERATURE,
-            model_name=MODEL_NAME,
-            openai_api_key=OPENAI_API_KEY,
-            verbose=True
-        )
+def _build_chain_refine():
+    retriever = get_retriever(top_k=3)
 
     chain = ConversationalRetrievalChain.from_llm(
         combine_docs_chain_kwargs = {'refine_prompt': QA_CHAIN_PROMPT_REFINE},
-        llm=llm,
+        llm=get_llm(),
         chain_type="refine",
         retriever=retriever,
         condense_question_prompt=CONDENSE_QUESTION_PROMPT,
@@ -145,126 +178,234 @@ def start_conversation_refine():
         return_generated_question = True,
         rephrase_question = False, # Does not return condensed question to LLM, only uses it for retrieval
         verbose=True)
-    
-    global currChain_Type 
-    currChain_Type = Chain_Type.REFINE.name
 
     return chain
+
+def start_conversation_refine():
+    return get_or_create(Chain_Type.REFINE.name, _build_chain_refine)
 ### -----------------------------end MODEL EVAL-----------------------------###
 
-def conversational_chat(chain, query):
-    resultIds = []
-    queryId = ""
+def get_answer_cache():
+    return get_or_create('answer_cache', lambda: Cache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, path=ANSWER_CACHE_PATH, table='answers'))
 
-    result = chain({"question": query, "chat_history": st.session_state['history'], "helpline_text": helpline_text})
-    st.session_state['history'].append((query, result["answer"]))
+def get_inflight_group():
+    return get_or_create('inflight', Group)
+
+"""
+Answers only depend on the question when there is no chat history, so only first turns are cached.
+The source documents are cached with the answer so that a cache hit still records the Kendra
+queryid / resultids used by the feedback buttons. Identical first questions arriving while one is
+being answered wait for that answer (and share its queryid) instead of running the pipeline again;
+only the first one is streamed. The key includes the Kendra index version, so answers from before a
+sync of the index are not served afterwards.
+"""
+def cached_chain_call(chain, query, history, callbacks=None):
+    if history:
+        return run_turn(chain, query, history.for_prompt(), inputs={"helpline_text": helpline_text}, callbacks=callbacks)
+
+    answer_cache = get_answer_cache()
+    key = chain_type_of(chain) + ":" + get_index_version().current() + ":" + normalize_question(query)
+    with span('answer_cache') as attributes:
+        cached = answer_cache.get(key)
+        attributes['hit'] = cached is not None
+    if cached is not None:
+        print("-------------CACHE HIT---------------:", answer_cache.stats())
+        return {
+            "answer": cached["answer"],
+            "generated_question": cached["generated_question"],
+            "source_documents": [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in cached["source_documents"]],
+        }
+
+    def run():
+        result = run_turn(chain, query, [], inputs={"helpline_text": helpline_text}, callbacks=callbacks)
+        answer_cache.put(key, {
+            "answer": result["answer"],
+            "generated_question": result["generated_question"],
+            "source_documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in result["source_documents"]],
+        })
+        return result
+
+    # Users asking the same question at the same time share one run of the pipeline
+    group = get_inflight_group()
+    result, shared = group.do(key, run)
+    if shared:
+        mark('coalesced')
+        print("--------------COALESCED--------------:", group.stats())
+    return result
+
+"""
+Appends the links of the source documents to the answer of a chain call, unless the answer is the
+"do not have the answer" reply or a welcome. Returns the output and the result ids of the sources.
+"""
+def answer_with_sources(result):
+    resultIds = []
     output = result['answer']
-    queryId = result['source_documents'][0].metadata['result_id'][:36] # The queryid is the first 36 characters of the results-id string
 
     if bool(re.search("do not have the answer to your question|welcome", output)):
         for d in result['source_documents']:
             resultIds.append(d.metadata['result_id'])
     else:
-        output = output + '\n \n Related Source(s):'
+        output = output + '\n \n ' + SOURCES_HEADER
         urls=[]
         for d in result['source_documents']:
             if d.metadata['source'] not in urls:
                 output += '\n' + d.metadata['source']
                 urls.append(d.metadata['source'])
                 resultIds.append(d.metadata['result_id'])
+    return output, resultIds
+
+"""
+Runs one turn of the conversation held in `state` (a dict-like object, e.g. st.session_state, with
+a ChatHistory under 'history' and 'queryid' and 'resultids' lists) and returns the answer with its source links.
+`callbacks` are passed to the chain for this call only, e.g. a StreamHandler streaming the answer.
+"""
+def chat_turn(chain, query, state, callbacks=None):
+    queryId = ""
+
+    result = cached_chain_call(chain, query, state['history'], callbacks=callbacks)
+    state['history'].append((query, result["answer"]))
+    output, resultIds = answer_with_sources(result)
+    queryId = result['source_documents'][0].metadata['result_id'][:36] # The queryid is the first 36 characters of the results-id string
 
-    st.session_state['queryid'].append(queryId)   
-    st.session_state['resultids'].append(resultIds)            
+    state['queryid'].append(queryId)   
+    state['resultids'].append(resultIds)            
     #output = result['answer'] + '\n \n Source: ' + ((result['source_documents'][0]).metadata)['source']
     
+    history = state['history'].to_list()
+    chain_type = chain_type_of(chain)
 
     # Write to CSVs 
     header = ["Time_Enquired", "QueryId", "ResultIds", "Original Question", "Generated Question", "Answer", "Source_Doc", "Chat_History"]
     now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
-    data = [now, queryId, resultIds, query, result['generated_question'], result['answer'], result['source_documents'], st.session_state['history']]
+    data = [now, queryId, resultIds, query, result['generated_question'], result['answer'], result['source_documents'], history]
     file_path_qna = "./app/prev_records/qna.csv"
 
-    write_to_csv(header, data, file_path_qna)
+    with span('log_write'):
+        write_to_csv(header, data, file_path_qna)
 
     ### ------------------------------------------------------------------------###
     ### -----------------------------for MODEL EVAL-----------------------------###
     ### ------------------------------------------------------------------------###
     header = ["Time_Enquired", "QueryId", "Original_Question", "Generated_Question", "Answer", "Source_Doc", "Difference"]
     now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
-    data = [now, queryId, query, result['generated_question'], result['answer'], result['source_documents'], st.session_state['history'], currChain_Type]
+    data = [now, queryId, query, result['generated_question'], result['answer'], result['source_documents'], history, chain_type]
     file_path_comparison = "./app/prev_records/comparison.csv"
 
-    write_to_csv(header, data, file_path_comparison)
+    with span('log_write'):
+        write_to_csv(header, data, file_path_comparison)
     ### -----------------------------end MODEL EVAL-----------------------------###
 
     return output
-    
-def goodFeedback(queryid, resultids):
-    relevance_value = "RELEVANT"
-    relevance_items = []
-    tempList = []
-    
-    # print(resultids)
-    for id in resultids:
-        tempList.append(id)
-        relevance_item = {
-            "ResultId": id,
-            "RelevanceValue": relevance_value,
-        }
-        relevance_items.append(relevance_item)
 
-    feedback = kendra.submit_feedback(
-        QueryId = queryid,
-        IndexId = KENDRA_INDEX_ID,
-        RelevanceFeedbackItems = [relevance_items]
-    )
-
-    # Write to CSVs
-    header = ["Time_Enquired", "QueryId", "ResultIds", "Status", "Feedback"]
-    now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
-    data = [now, queryid, tempList, "RELEVANT", feedback]
-    file_path = "./app/prev_records/feedback.csv"
-
-    write_to_csv(header, data, file_path)
-
-def badFeedback(queryid, resultids):
-    relevance_value = "NOT_RELEVANT"
-    relevance_items = []
-    tempList = []
-    for id in resultids:
-        tempList.append(id)
-        relevance_item = {
-            "ResultId": id,
-            "RelevanceValue": relevance_value,
-        }
-        relevance_items.append(relevance_item)
+def conversational_chat(chain, query, callbacks=None):
+    return chat_turn(chain, query, st.session_state, callbacks=callbacks)
 
-    feedback = kendra.submit_feedback(
-        QueryId = queryid,
-        IndexId = KENDRA_INDEX_ID,
-        RelevanceFeedbackItems = [relevance_items]
-    )
+"""
+Answers from the FAQ index when `question` matches an approved entry with an answer in `lang`, and
+records the turn in `state` like chat_turn does. Returns the answer in `lang`, or None.
+"""
+def faq_turn(question, lang, state):
+    faq = get_faq_index()
+    if not faq:
+        return None
+    with span('faq') as attributes:
+        entry, answer = faq.lookup(question, lang)
+        attributes['hit'] = entry is not None
+    if entry is None:
+        return None
+    print("---------------FAQ HIT---------------:", entry, lang)
+
+    query = QUESTION_PREFIX + faq.entries[entry]['question']
+    english = faq.entries[entry]['answers']['en']
+    state['history'].append((query, english.partition(SOURCES_HEADER)[0].rstrip()))
+    state['queryid'].append(FAQ_QUERY_PREFIX + entry)
+    state['resultids'].append([entry])
 
-    # Write to CSVs
-    header = ["Time_Enquired", "QueryId", "ResultIds", "Status", "Feedback"]
+    header = ["Time_Enquired", "QueryId", "ResultIds", "Original Question", "Generated Question", "Answer", "Source_Doc", "Chat_History"]
     now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
-    data = [now, queryid, tempList, "NOT_RELEVANT", feedback]
-    file_path = "./app/prev_records/feedback.csv"
+    data = [now, FAQ_QUERY_PREFIX + entry, [entry], question, query, english, "FAQ", state['history'].to_list()]
+    with span('log_write'):
+        write_to_csv(header, data, "./app/prev_records/qna.csv")
+    return answer
 
-    write_to_csv(header, data, file_path)
+"""
+Answers a message as typed by the user, in their language: detects the language, translates the
+message to English, runs the turn and translates the answer back. The message and the reply are
+added to state['past'] and state['generated'], and the language to state['lang']. When a
+`placeholder` is given the answer is streamed into it while it is generated. Common questions are
+answered from the FAQ index without the chain.
+"""
+def respond(chain, user_input, state, placeholder=None):
+    trace = start_trace()
+    with span('detect'):
+        lang = detect_language(user_input)
+    print("------------DETECTED LANG------------:", lang)
+    print("---------------ORIGINAL--------------:", user_input)
+
+    if lang in ['sk', 'ceb']:
+        lang = 'tl'
+    state['lang'] = lang
+
+    # A first message is looked up as typed, saving the translation too
+    og = faq_turn(user_input, lang, state) if not state['history'] else None
+    if og is not None:
+        return _finish_respond(trace, user_input, og, state, lang=lang, question=user_input)
+    
+    if lang != 'en':
+        with span('translate_in'):
+            translated = translate(user_input, 'auto', 'en')
+        print("-------------TRANSLATED--------------:", translated)
+        response_text = translated
+        
+    else:
+        response_text = user_input
+
+    response_text = "As a migrant domestic worker, " + response_text 
+
+    # Follow-ups that need the chat history to be understood always go to the chain
+    history = state['history']
+    if (lang != 'en' or history) and not (history and needs_rephrase(response_text, history.turns[-1][0])[0]):
+        og = faq_turn(response_text, lang, state)
+        if og is not None:
+            return _finish_respond(trace, user_input, og, state, lang=lang, question=response_text)
+
+    stream_handler = StreamHandler(placeholder, lang=lang) if placeholder is not None else None
+    output = chat_turn(
+        chain,
+        response_text,
+        state,
+        callbacks=[stream_handler] if stream_handler else None
+    )
+    if stream_handler and stream_handler.first_token_at:
+        mark('first_token', at=stream_handler.first_token_at)
+
+    with span('translate_out'):
+        if stream_handler:
+            og = stream_handler.finalize(output)
+        else:
+            output = output.replace("$", "SGD")
+            og = translate_output(output, lang)
+    return _finish_respond(trace, user_input, og, state, lang=lang, question=response_text)
+
+def _finish_respond(trace, user_input, og, state, **fields):
+    state['past'].append(user_input)
+    state['generated'].append(og)
+    with span('session_write'):
+        record_turn(state)
+    finish_trace(trace, user_input=user_input, queryid=state['queryid'][-1], **fields)
+    return og
+    
+"""
+Records a 👍 ("RELEVANT") or 👎 ("NOT_RELEVANT") click. The feedback is queued and submitted to
+Kendra in the background, so the rerun is not held up by the AWS round trip.
+"""
+def giveFeedback(queryid, resultids, relevance_value, click_key=None):
+    get_feedback_queue().submit(queryid, resultids, relevance_value, click_key)
 
 
 """
 A function that allows to add a row of data accordingly. It will add a header if the file does not exists.
+The row is queued on the shared log sink and written in the background, so this never blocks.
 """
 def write_to_csv(header, data, file_path):
-    # Check if the file exists
-    file_exists = os.path.exists(file_path)
-
-    with open(file_path, 'a', encoding='UTF8',newline='') as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(header)
-
-        writer.writerow(data)
-
+    get_log_sink().write(file_path, header, data)
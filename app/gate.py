@@ -0,0 +1,78 @@
+# standard library modules
+import re
+from datetime import datetime
+
+# third-party modules
+import pytz
+
+# local modules
+from logsink import get_log_sink
+
+QUESTION_PREFIX = "As a migrant domestic worker, "
+
+# Words that only make sense with the previous turn in mind
+REFERRING_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "theirs",
+    "he", "him", "his", "she", "her", "hers", "then", "same", "such", "above",
+    "previous", "earlier", "else", "instead", "again", "former", "latter",
+}
+# Openings that continue the previous question rather than ask a new one
+CONTINUATIONS = re.compile(r"^(and|or|but|also|so|then|what about|how about|what if|why not|how come|in that case|if so|if not)\b")
+
+STOPWORDS = {
+    "a", "an", "the", "i", "me", "my", "we", "our", "you", "your", "is", "am", "are", "was", "were",
+    "be", "been", "do", "does", "did", "can", "could", "should", "would", "will", "shall", "may",
+    "might", "must", "have", "has", "had", "to", "of", "in", "on", "at", "for", "with", "from", "by",
+    "about", "as", "if", "what", "when", "where", "which", "who", "whom", "how", "not", "no", "yes",
+    "please", "there", "any", "some", "get", "need", "want",
+}
+MIN_CONTENT_WORDS = 3
+
+GATE_LOG_PATH = "./app/prev_records/gate.csv"
+
+
+def _words(text):
+    return re.findall(r"[a-z']+", text.casefold())
+
+
+def _content_words(words):
+    return {w for w in words if w not in STOPWORDS and w not in REFERRING_WORDS}
+
+
+"""
+Decides locally, before any LLM call, whether a follow-up question has to be rephrased with the chat
+history to be understood. A question is sent to the condense step only when it refers back to the
+conversation (pronouns like "it" or "that", openings like "what about"), or when it is too short to
+stand on its own. Returns (needs_rephrase, reason, similarity), where similarity is the overlap of
+content words with the previous question, logged to help tune the gate.
+"""
+def needs_rephrase(question, last_question):
+    question = question[len(QUESTION_PREFIX):] if question.startswith(QUESTION_PREFIX) else question
+    last_question = last_question or ""
+    last_question = last_question[len(QUESTION_PREFIX):] if last_question.startswith(QUESTION_PREFIX) else last_question
+
+    words = _words(question)
+    content = _content_words(words)
+    last_content = _content_words(_words(last_question))
+    similarity = len(content & last_content) / len(content | last_content) if content | last_content else 0.0
+
+    if CONTINUATIONS.match(" ".join(words)):
+        return True, "continuation", similarity
+    referring = REFERRING_WORDS.intersection(words)
+    if referring:
+        return True, "refers to " + ",".join(sorted(referring)), similarity
+    if len(content) < MIN_CONTENT_WORDS:
+        return True, "too short", similarity
+    return False, "self-contained", similarity
+
+
+"""
+Records a gate decision. `condense_ms` and `changed` (whether the condense step actually changed the
+question) are only known when the question was rephrased; a rephrase that did not change the question
+was a round trip the gate could have saved.
+"""
+def log_decision(question, last_question, rephrase, reason, similarity, condense_ms=None, changed=None):
+    header = ["Time_Enquired", "Question", "Last_Question", "Rephrase", "Reason", "Similarity", "Condense_ms", "Changed"]
+    now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
+    data = [now, question, last_question, rephrase, reason, round(similarity, 3), condense_ms, changed]
+    get_log_sink().write(GATE_LOG_PATH, header, data)
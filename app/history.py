@@ -0,0 +1,125 @@
+# standard library modules
+import threading
+
+# third-party modules
+from langchain.prompts import PromptTemplate
+from langchain.schema import SystemMessage
+
+# local modules
+from constants import (
+    MODEL_NAME,
+    HISTORY_TOKEN_BUDGET
+)
+from clients import (
+    get_executor,
+    get_llm
+)
+from ratelimit import count_tokens
+
+summary_template = """Progressively summarise the conversation between a migrant domestic worker and a chatbot,
+adding onto the previous summary and returning a new summary of at most 120 words.
+Keep the topics, the worker's situation and any facts the chatbot gave that later questions may refer to.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+SUMMARY_PROMPT = PromptTemplate.from_template(summary_template)
+
+
+"""
+The chat history of one conversation, bounded by a token budget.
+
+The most recent turns are kept verbatim as long as they fit in `token_budget` tokens (the last turn
+is always kept). Older turns are folded into a running summary by a background LLM call, so the
+summary is never computed while the user is waiting; until it finishes, the previous summary is used.
+`summarized` counts the turns folded into the summary; `on_summary(summary, summarized)`, when set,
+is called with every new summary, e.g. to persist it.
+"""
+class ChatHistory:
+    def __init__(self, token_budget=HISTORY_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.turns = [] # [(query, answer, tokens)]
+        self.summary = ""
+        self.summarized = 0
+        self.on_summary = None
+        self._evicted = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    def append(self, turn):
+        query, answer = turn
+        with self._lock:
+            self.turns.append((query, answer, count_tokens(query + "\n" + answer, MODEL_NAME)))
+            while len(self.turns) > 1 and sum(t[2] for t in self.turns) > self.token_budget:
+                self._evicted.append(self.turns.pop(0)[:2])
+
+            if self._evicted and not self._summarizing:
+                self._summarizing = True
+                get_executor().submit(self._summarize)
+
+    """
+    Sets the history as it was saved, e.g. by the session store: the recent turns [(query, answer)],
+    the summary and the number of turns folded into it. Nothing is evicted or summarized until the
+    next append().
+    """
+    def restore(self, turns, summary, summarized):
+        with self._lock:
+            self.turns = [(q, a, count_tokens(q + "\n" + a, MODEL_NAME)) for q, a in turns]
+            self.summary = summary
+            self.summarized = summarized
+
+    def _summarize(self):
+        while True:
+            with self._lock:
+                evicted, self._evicted = self._evicted, []
+                summary = self.summary
+                if not evicted:
+                    self._summarizing = False
+                    return
+
+            new_lines = "\n".join(f"Human: {q}\nAssistant: {a}" for q, a in evicted)
+            try:
+                summary = get_llm().predict(SUMMARY_PROMPT.format(summary=summary or "(none)", new_lines=new_lines)).strip()
+            except Exception as e:
+                print("------------SUMMARY ERROR------------:", e)
+                with self._lock:
+                    # retried with the next append
+                    self._evicted = evicted + self._evicted
+                    self._summarizing = False
+                return
+
+            with self._lock:
+                self.summary = summary
+                self.summarized += len(evicted)
+                summarized = self.summarized
+            if self.on_summary:
+                self.on_summary(summary, summarized)
+
+    """
+    The history as passed to the chain: the summary (if any) followed by the recent turns.
+    """
+    def for_prompt(self):
+        with self._lock:
+            messages = [SystemMessage(content="Summary of the earlier conversation: " + self.summary)] if self.summary else []
+            return messages + [(q, a) for q, a, _ in self.turns]
+
+    """
+    The history as written to the logs.
+    """
+    def to_list(self):
+        with self._lock:
+            summary = [("Summary", self.summary)] if self.summary else []
+            return summary + [(q, a) for q, a, _ in self.turns]
+
+    def __bool__(self):
+        return bool(self.turns or self.summary)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        return iter(self.to_list())
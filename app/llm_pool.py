@@ -0,0 +1,267 @@
+# standard library modules
+import asyncio
+import re
+import threading
+import time
+from typing import Any, List, Optional
+
+# third-party modules
+import openai
+from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+
+"""
+Spreads OpenAI calls over several API keys, each with its own requests-per-minute and
+tokens-per-minute limits.
+
+The remaining quota of every key is read from the x-ratelimit-* headers of its responses, and each
+call goes to the key with the most headroom left, counting the calls still in flight on it. A key
+that answers 429 is left alone until its limit resets, and the call is retried at once on another
+key; other transient errors are retried with a short backoff.
+"""
+
+# errors worth retrying on another key
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+QUOTA_COOLDOWN = 60.0 # seconds a key that ran out of credit is left alone
+THROTTLE_COOLDOWN = 1.0 # seconds a throttled key is left alone when the response does not say
+
+_duration = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_seconds = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+# Parses the reset durations of the rate limit headers, e.g. "20ms", "1s" or "6m0s"
+def parse_duration(value):
+    return sum(float(n) * _seconds[unit] for n, unit in _duration.findall(value or ""))
+
+
+"""
+What is known about the quota of one key, from the last response it got.
+"""
+class KeyState:
+    def __init__(self, key, label):
+        self.key = key
+        self.label = label
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.cooling_until = 0.0
+        self.observed = 0.0
+        self.limit_requests = self.remaining_requests = self.reset_requests = None
+        self.limit_tokens = self.remaining_tokens = self.reset_tokens = None
+
+    # Fraction of a limit left at `now`, assuming it refills linearly until its reset time
+    def _fraction(self, limit, remaining, reset, now, pending=0):
+        if not limit:
+            return 1.0 - pending / 100.0
+        elapsed = now - self.observed
+        if reset and elapsed < reset:
+            remaining += (limit - remaining) * elapsed / reset
+        else:
+            remaining = limit
+        return (remaining - pending) / limit
+
+    def headroom(self, now):
+        return min(
+            self._fraction(self.limit_requests, self.remaining_requests, self.reset_requests, now, pending=self.in_flight),
+            self._fraction(self.limit_tokens, self.remaining_tokens, self.reset_tokens, now),
+        )
+
+
+class KeyPool:
+    def __init__(self, keys):
+        self.keys = [KeyState(key, f"key{i + 1}") for i, key in enumerate(keys)]
+        self._by_key = {state.key: state for state in self.keys}
+        self._lock = threading.Lock()
+
+    """
+    Takes the key with the most headroom, waiting for one to cool down if all of them are throttled.
+    Keys in `exclude` are only taken when there is no other.
+    """
+    def acquire(self, exclude=()):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready = [s for s in self.keys if s.cooling_until <= now]
+                if ready:
+                    preferred = [s for s in ready if s not in exclude] or ready
+                    state = max(preferred, key=lambda s: s.headroom(now))
+                    state.in_flight += 1
+                    state.calls += 1
+                    return state
+                wait = min(s.cooling_until for s in self.keys) - now
+            time.sleep(wait)
+
+    def release(self, state):
+        with self._lock:
+            state.in_flight -= 1
+
+    """
+    Records the rate limit headers of a response to the key that made it; a 429 puts the key to rest
+    until the exhausted limit resets.
+    """
+    def observe(self, key, headers, status=200):
+        state = self._by_key.get(key)
+        if state is None or headers is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if headers.get('x-ratelimit-limit-requests'):
+                state.observed = now
+                state.limit_requests = int(headers['x-ratelimit-limit-requests'])
+                state.remaining_requests = int(headers.get('x-ratelimit-remaining-requests', state.limit_requests))
+                state.reset_requests = parse_duration(headers.get('x-ratelimit-reset-requests'))
+            if headers.get('x-ratelimit-limit-tokens'):
+                state.observed = now
+                state.limit_tokens = int(headers['x-ratelimit-limit-tokens'])
+                state.remaining_tokens = int(headers.get('x-ratelimit-remaining-tokens', state.limit_tokens))
+                state.reset_tokens = parse_duration(headers.get('x-ratelimit-reset-tokens'))
+            if status == 429:
+                state.cooling_until = max(state.cooling_until, now + self._cooldown(headers))
+
+    """
+    Records a failed call: a throttled key rests for `cooldown` seconds, or until its limit resets.
+    """
+    def failed(self, state, throttled, headers=None, cooldown=None):
+        with self._lock:
+            if not throttled:
+                state.errors += 1
+                return
+            state.throttled += 1
+            cooldown = self._cooldown(headers or {}) if cooldown is None else cooldown
+            state.cooling_until = max(state.cooling_until, time.monotonic() + cooldown)
+
+    def _cooldown(self, headers):
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+        resets = []
+        if headers.get('x-ratelimit-remaining-requests') == '0':
+            resets.append(parse_duration(headers.get('x-ratelimit-reset-requests')))
+        if headers.get('x-ratelimit-remaining-tokens') == '0':
+            resets.append(parse_duration(headers.get('x-ratelimit-reset-tokens')))
+        return max(resets) if resets else THROTTLE_COOLDOWN
+
+    """
+    Response hook for the requests session used by the openai package, so that every sync call
+    updates the quota of its key.
+    """
+    def observe_response(self, response, *args, **kwargs):
+        authorization = response.request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            self.observe(authorization[len('Bearer '):], response.headers, response.status_code)
+
+    """
+    Per-key utilization: calls made, 429s, other errors, calls in flight, the last known remaining
+    quota and the share of the tighter limit in use.
+    """
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                state.label: {
+                    'calls': state.calls,
+                    'throttled': state.throttled,
+                    'errors': state.errors,
+                    'in_flight': state.in_flight,
+                    'remaining_requests': state.remaining_requests,
+                    'remaining_tokens': state.remaining_tokens,
+                    'utilization': round(1.0 - state.headroom(now), 3),
+                    'cooling': state.cooling_until > now,
+                }
+                for state in self.keys
+            }
+
+
+"""
+Passes the streaming callbacks of a call through, noting whether any token was streamed.
+"""
+class _StreamWatch:
+    def __init__(self, run_manager):
+        self.run_manager = run_manager
+        self.streamed = False
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.streamed = True
+        return self.run_manager.on_llm_new_token(token, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.run_manager, name)
+
+
+"""
+A chat model that runs every call on one of a set of ChatOpenAI clients, one per key of `pool`,
+picking the key as described above. The clients retry nothing themselves (max_retries=1); up to
+`max_attempts` attempts are made across keys. Streaming callbacks are passed through unchanged; a
+call that fails after streaming tokens is not retried, as the user has already seen part of the
+answer. A failed key is released before the backoff, so it does not count as in flight meanwhile.
+"""
+class PooledChatModel(BaseChatModel):
+    pool: Any
+    models: List[Any]
+    max_attempts: int = 6
+
+    @classmethod
+    def create(cls, pool, max_attempts=6, **kwargs):
+        models = [ChatOpenAI(openai_api_key=state.key, max_retries=1, **kwargs) for state in pool.keys]
+        return cls(pool=pool, models=models, max_attempts=max_attempts)
+
+    @property
+    def _llm_type(self) -> str:
+        return "openai-chat-pool"
+
+    @property
+    def _identifying_params(self):
+        return self.models[0]._identifying_params
+
+    def _model(self, state):
+        return self.models[self.pool.keys.index(state)]
+
+    def _failed(self, state, error, attempt):
+        if isinstance(error, openai.error.RateLimitError):
+            # a key out of credit rests longer than one over its per-minute limits
+            cooldown = QUOTA_COOLDOWN if error.code == 'insufficient_quota' else None
+            self.pool.failed(state, True, error.headers, cooldown)
+            print("------------LLM FAILOVER-------------:", state.label, "throttled")
+            return 0.0
+        self.pool.failed(state, False)
+        print("------------LLM FAILOVER-------------:", state.label, error)
+        return min(2 ** attempt * 0.5, 8.0)
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tried = []
+        for attempt in range(self.max_attempts):
+            state = self.pool.acquire(exclude=tried)
+            watch = _StreamWatch(run_manager) if run_manager else None
+            try:
+                return self._model(state)._generate(messages, stop=stop, run_manager=watch, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_attempts - 1 or (watch and watch.streamed):
+                    raise
+                tried.append(state)
+                delay = self._failed(state, e, attempt)
+            finally:
+                self.pool.release(state)
+            time.sleep(delay)
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tried = []
+        for attempt in range(self.max_attempts):
+            state = await asyncio.to_thread(self.pool.acquire, tried)
+            watch = _StreamWatch(run_manager) if run_manager else None
+            try:
+                return await self._model(state)._agenerate(messages, stop=stop, run_manager=watch, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_attempts - 1 or (watch and watch.streamed):
+                    raise
+                tried.append(state)
+                delay = self._failed(state, e, attempt)
+            finally:
+                self.pool.release(state)
+            await asyncio.sleep(delay)
@@ -0,0 +1,224 @@
+# standard library modules
+import json
+import os
+import re
+import sys
+import uuid
+import zlib
+from typing import Any, List
+
+# third-party modules
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun
+)
+from langchain.schema import BaseRetriever, Document
+
+# local modules
+from constants import (
+    DOCUMENT,
+    LOCAL_INDEX_DIR,
+    LOCAL_DENSE_WEIGHT,
+    LOCAL_DOCUMENT_URL
+)
+
+"""
+An in-process alternative to the Kendra index, built once from the MDW source document.
+
+The document is split into overlapping chunks which are scored against a query with BM25 plus the
+cosine similarity of hashed character n-gram vectors (robust to spelling variants and word forms),
+both computed with NumPy over arrays that are memory-mapped from LOCAL_INDEX_DIR.
+    python app/local_retriever.py build [path to the PDF or a .txt export]
+
+The "dense" vectors are not learned embeddings: they are feature-hashed character 3- and 4-grams,
+which need no embedding model or API call but only match surface forms, not meaning. Paraphrases
+sharing no words with the passage are left to BM25 and, behind the fallback retriever, to Kendra.
+"""
+
+CHUNK_CHARS = 900
+CHUNK_OVERLAP = 150
+DENSE_DIM = 512
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Query ids of local results start with this prefix, so they are never sent to Kendra as feedback
+LOCAL_QUERY_PREFIX = "local-"
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def hashed_vector(text):
+    vector = np.zeros(DENSE_DIM, dtype=np.float32)
+    text = " " + " ".join(tokenize(text)) + " "
+    for n in (3, 4):
+        for i in range(len(text) - n + 1):
+            h = zlib.crc32(text[i:i + n].encode())
+            vector[h % DENSE_DIM] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def read_pages(path):
+    if path.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise ImportError("Reading the PDF needs pypdf: pip install pypdf (or pass a .txt export of the document)")
+        return [page.extract_text() or "" for page in PdfReader(path).pages]
+
+    with open(path, encoding='utf-8') as f:
+        # Form feeds separate pages in text exports
+        return f.read().split("\f")
+
+
+def chunk_pages(pages):
+    chunks = []
+    for number, page in enumerate(pages, start=1):
+        text = " ".join(page.split())
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + CHUNK_CHARS)
+            if end < len(text):
+                # end on a sentence boundary where possible
+                boundary = text.rfind(". ", start + CHUNK_CHARS // 2, end)
+                end = boundary + 1 if boundary != -1 else end
+            chunks.append({'text': text[start:end].strip(), 'page': number})
+            if end >= len(text):
+                break
+            start = max(end - CHUNK_OVERLAP, start + 1)
+    return [c for c in chunks if c['text']]
+
+
+"""
+Chunks the document and writes the chunk texts, the BM25 postings (CSR layout: per term, a slice of
+chunk ids and precomputed term weights) and the dense vectors to `index_dir`.
+"""
+def build_index(path, index_dir=LOCAL_INDEX_DIR):
+    chunks = chunk_pages(read_pages(path))
+    documents = [tokenize(c['text']) for c in chunks]
+    lengths = np.array([len(d) for d in documents], dtype=np.float32)
+    avgdl = float(lengths.mean()) if len(lengths) else 0.0
+
+    vocabulary = {}
+    postings = {}
+    for doc_id, tokens in enumerate(documents):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            term = vocabulary.setdefault(token, len(vocabulary))
+            weight = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / avgdl))
+            postings.setdefault(term, []).append((doc_id, weight))
+
+    indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    doc_ids, weights = [], []
+    for term in range(len(vocabulary)):
+        entries = postings[term]
+        indptr[term + 1] = indptr[term] + len(entries)
+        doc_ids.extend(d for d, _ in entries)
+        weights.extend(w for _, w in entries)
+    df = np.diff(indptr).astype(np.float32)
+    idf = np.log(1 + (len(chunks) - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'indptr.npy'), indptr)
+    np.save(os.path.join(index_dir, 'doc_ids.npy'), np.array(doc_ids, dtype=np.int32))
+    np.save(os.path.join(index_dir, 'weights.npy'), np.array(weights, dtype=np.float32))
+    np.save(os.path.join(index_dir, 'idf.npy'), idf)
+    np.save(os.path.join(index_dir, 'dense.npy'), np.stack([hashed_vector(c['text']) for c in chunks]) if chunks else np.zeros((0, DENSE_DIM), dtype=np.float32))
+    with open(os.path.join(index_dir, 'vocabulary.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocabulary, f)
+    with open(os.path.join(index_dir, 'chunks.jsonl'), 'w', encoding='utf-8') as f:
+        for c in chunks:
+            f.write(json.dumps({'text': c['text'], 'page': c['page'], 'source': os.path.basename(path)}) + "\n")
+
+    print(f"Indexed {len(chunks)} chunks, {len(vocabulary)} terms into {index_dir}")
+
+
+"""
+The index read from `index_dir`, with the large arrays memory-mapped.
+"""
+class LocalIndex:
+    def __init__(self, index_dir=LOCAL_INDEX_DIR, dense_weight=LOCAL_DENSE_WEIGHT):
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode='r')
+        self.indptr = load('indptr.npy')
+        self.doc_ids = load('doc_ids.npy')
+        self.weights = load('weights.npy')
+        self.idf = load('idf.npy')
+        self.dense = load('dense.npy')
+        self.dense_weight = dense_weight
+        with open(os.path.join(index_dir, 'vocabulary.json'), encoding='utf-8') as f:
+            self.vocabulary = json.load(f)
+        with open(os.path.join(index_dir, 'chunks.jsonl'), encoding='utf-8') as f:
+            self.chunks = [json.loads(line) for line in f]
+
+    def bm25(self, query):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in {self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary}:
+            start, end = self.indptr[term], self.indptr[term + 1]
+            np.add.at(scores, self.doc_ids[start:end], self.idf[term] * self.weights[start:end])
+        return scores
+
+    """
+    Returns [(chunk index, score)] of the `top_k` best chunks. Both scores are scaled to [0, 1] by
+    their maximum before being mixed, so `dense_weight` is the share of the dense score.
+    """
+    def search(self, query, top_k=3):
+        if not self.chunks:
+            return []
+        bm25 = self.bm25(query)
+        dense = np.clip(self.dense @ hashed_vector(query), 0, None)
+        scores = (1 - self.dense_weight) * bm25 / (bm25.max() or 1) + self.dense_weight * dense / (dense.max() or 1)
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(i), float(scores[i])) for i in best]
+
+
+"""
+A retriever over the LocalIndex, interchangeable with AmazonKendraRetriever: documents carry the
+same `source`, `title`, `excerpt` and `result_id` metadata. Result ids follow Kendra's
+"<query id>-<result id>" shape, with query ids starting with LOCAL_QUERY_PREFIX. The `source` is a
+link to the page when LOCAL_DOCUMENT_URL is set, otherwise plain text naming the document and page,
+so it is not shown as a link.
+"""
+class LocalRetriever(BaseRetriever):
+    index: Any
+    top_k: int = 3
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _search(self, query):
+        query_id = LOCAL_QUERY_PREFIX + uuid.uuid4().hex[:36 - len(LOCAL_QUERY_PREFIX)]
+        documents = []
+        for i, score in self.index.search(query, self.top_k):
+            chunk = self.index.chunks[i]
+            documents.append(Document(
+                page_content=chunk['text'],
+                metadata={
+                    'source': f"{LOCAL_DOCUMENT_URL}#page={chunk['page']}" if LOCAL_DOCUMENT_URL else f"{chunk['source']}, page {chunk['page']}",
+                    'title': chunk['source'],
+                    'excerpt': chunk['text'],
+                    'result_id': f"{query_id}-{i}",
+                    'score': score,
+                },
+            ))
+        return documents
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self._search(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return self._search(query)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        build_index(sys.argv[2] if len(sys.argv) > 2 else os.path.join("./app/static", DOCUMENT))
+    else:
+        print("usage: python app/local_retriever.py build [path to the PDF or a .txt export]")
@@ -0,0 +1,237 @@
+# standard library modules
+import atexit
+import csv
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# local modules
+from constants import (
+    LOG_BACKEND,
+    LOG_DB_PATH,
+    LOG_STORE_DIR,
+    LOG_BATCH_SIZE,
+    LOG_FLUSH_INTERVAL,
+    LOG_QUEUE_SIZE,
+    LOG_ROTATE_BYTES,
+    LOG_ROTATE_SECONDS
+)
+from clients import get_or_create
+from logstore import ContentStore
+
+"""
+Appends batches of rows to CSV files, adding the header to new files. A file is rotated (renamed with
+a timestamp suffix) once it grows past `max_bytes`, or once it was last written in an earlier
+`max_age` period than now, e.g. every day for max_age=86400. 0 disables either rule.
+"""
+class CsvBackend:
+    def __init__(self, max_bytes=0, max_age=0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def write_rows(self, file_path, header, rows):
+        self._rotate(file_path)
+        file_exists = os.path.exists(file_path)
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+
+        with open(file_path, 'a', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            if not file_exists:
+                writer.writerow(header)
+            writer.writerows(rows)
+
+    def _rotate(self, file_path):
+        if not os.path.exists(file_path):
+            return
+
+        stat = os.stat(file_path)
+        too_big = self.max_bytes and stat.st_size >= self.max_bytes
+        too_old = self.max_age and int(stat.st_mtime // self.max_age) < int(time.time() // self.max_age)
+        if too_big or too_old:
+            root, ext = os.path.splitext(file_path)
+            os.rename(file_path, root + datetime.now().strftime(".%Y%m%dT%H%M%S") + ext)
+
+    def close(self):
+        pass
+
+
+"""
+Stores every log file as a table of one SQLite database, named after the file, e.g. qna.csv -> qna.
+Values that are not strings or numbers are stored as their str(), as the CSV writer does. The header
+names are kept in the log_headers table, so read_log() returns rows keyed as in the CSV.
+"""
+class SqliteBackend:
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        # Only used from the sink's worker thread
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log_headers (log TEXT, column_name TEXT, header TEXT, PRIMARY KEY (log, column_name))')
+        self._tables = set()
+
+    def write_rows(self, file_path, header, rows):
+        table = _identifier(os.path.splitext(os.path.basename(file_path))[0])
+        columns = [_identifier(h) for h in header]
+        width = max(len(columns), max(len(r) for r in rows))
+        columns += [f'column_{i}' for i in range(len(columns), width)]
+
+        if table not in self._tables:
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(c + " TEXT" for c in columns)})')
+            existing = [r[1] for r in self.db.execute(f'PRAGMA table_info({table})')]
+            for c in columns:
+                if c not in existing:
+                    self.db.execute(f'ALTER TABLE {table} ADD COLUMN {c} TEXT')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO log_headers (log, column_name, header) VALUES (?, ?, ?)',
+                [(table, c, h) for c, h in zip(columns, header)]
+            )
+            self._tables.add(table)
+
+        values = [[_value(v) for v in r] + [None] * (width - len(r)) for r in rows]
+        self.db.executemany(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * width)})',
+            values
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def _identifier(name):
+    return re.sub(r'\W', '_', name).strip('_').lower() or 'log'
+
+
+def _value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+"""
+Collects log rows on an in-memory queue and writes them from a background thread in batches, so
+logging never blocks a user's turn. Rows are grouped per file and flushed once `batch_size` rows are
+waiting or `flush_interval` seconds have passed. If the queue is full the row is dropped with a
+warning rather than blocking.
+"""
+class LogSink:
+    def __init__(self, backend, batch_size=100, flush_interval=1.0, max_queue=10000):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}
+        self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+        self._thread.start()
+
+    def write(self, file_path, header, row):
+        try:
+            self._queue.put_nowait((file_path, header, row))
+        except queue.Full:
+            self.dropped += 1
+            print("-------------LOG DROPPED-------------:", file_path, self.dropped)
+
+    """
+    Blocks until every row written so far has been handed to the backend.
+    """
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        waiting = 0
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                self._flush_pending()
+                item.set()
+                waiting = 0
+                last_flush = time.monotonic()
+                continue
+
+            if item is not None:
+                file_path, header, row = item
+                self._pending.setdefault(file_path, (header, []))[1].append(row)
+                waiting += 1
+
+            if waiting >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_pending()
+                waiting = 0
+                last_flush = time.monotonic()
+
+    def _flush_pending(self):
+        pending, self._pending = self._pending, {}
+        for file_path, (header, rows) in pending.items():
+            try:
+                self.backend.write_rows(file_path, header, rows)
+            except Exception as e:
+                print("-------------LOG ERROR---------------:", file_path, e)
+
+
+def _create_log_sink():
+    if LOG_BACKEND == 'sqlite':
+        backend = SqliteBackend(LOG_DB_PATH)
+    elif LOG_BACKEND == 'store':
+        backend = ContentStore(LOG_STORE_DIR)
+    else:
+        backend = CsvBackend(max_bytes=LOG_ROTATE_BYTES, max_age=LOG_ROTATE_SECONDS)
+
+    sink = LogSink(backend, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL, max_queue=LOG_QUEUE_SIZE)
+    atexit.register(sink.flush)
+    return sink
+
+
+def get_log_sink():
+    return get_or_create('log_sink', _create_log_sink)
+
+
+# Streams the rows of the table the sqlite backend writes for `file_path`, keyed by the original header
+def _read_sqlite_log(file_path):
+    if not os.path.exists(LOG_DB_PATH):
+        return
+    table = _identifier(os.path.splitext(os.path.basename(file_path))[0])
+    db = sqlite3.connect(LOG_DB_PATH)
+    try:
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+            return
+        try:
+            headers = dict(db.execute('SELECT column_name, header FROM log_headers WHERE log = ?', (table,)).fetchall())
+        except sqlite3.OperationalError:
+            # a database written before the headers were kept
+            headers = {}
+        cursor = db.execute(f'SELECT * FROM {table} ORDER BY rowid')
+        names = [headers.get(d[0], d[0]) for d in cursor.description]
+        for row in cursor:
+            yield {name: '' if value is None else str(value) for name, value in zip(names, row)}
+    finally:
+        db.close()
+
+
+"""
+Streams the rows of a log as dicts, like csv.DictReader, from the CSV file or, with
+LOG_BACKEND=store or sqlite, from the content store or the database.
+"""
+def read_log(file_path):
+    if LOG_BACKEND == 'store':
+        yield from ContentStore(LOG_STORE_DIR).read_dicts(file_path)
+        return
+    if LOG_BACKEND == 'sqlite':
+        yield from _read_sqlite_log(file_path)
+        return
+    try:
+        with open(file_path, newline='') as f:
+            yield from csv.DictReader(f)
+    except FileNotFoundError:
+        return
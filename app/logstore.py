@@ -0,0 +1,210 @@
+# standard library modules
+import csv
+import hashlib
+import json
+import os
+import sys
+
+# third-party modules
+from langchain.schema import Document
+
+# local modules
+from constants import LOG_STORE_DIR
+
+"""
+A content-addressed log format. Every source passage and every chat turn is stored once, keyed by
+the hash of its content, and log rows refer to them by id instead of repeating them:
+
+    passages.jsonl      {"id", "page_content", "metadata"}, metadata without the per-query result_id
+    turns.jsonl         {"id", "turn"}, one (query, answer) pair
+    rows/<log>.jsonl    the header, then one JSON list per row; source documents are stored as
+                        {"passages": [[id, result_id, position of result_id in the metadata], ...]}
+                        and chat histories as {"summary", "turns": [id, ...]}
+
+A turn's id depends on the turn alone, so when the history window drops its oldest turn or the
+summary changes, the turns still in the window keep their ids and are not stored again.
+
+The files are append-only. read() streams the rows of a log with the documents and histories
+resolved again, and export() rebuilds the CSV the csv backend would have written, e.g.
+    python app/logstore.py export qna.csv [./app/prev_records/qna.csv]
+"""
+
+PASSAGE_COLUMNS = {"Source_Doc"}
+HISTORY_COLUMNS = {"Chat_History", "Difference"} # comparison.csv logs the history under "Difference"
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()[:20]
+
+
+def _read_jsonl(path):
+    try:
+        with open(path, encoding='UTF8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a line still being written by the log sink
+                    continue
+    except FileNotFoundError:
+        return
+
+
+class ContentStore:
+    def __init__(self, directory=LOG_STORE_DIR):
+        self.directory = directory
+        self.passages_path = os.path.join(directory, 'passages.jsonl')
+        self.turns_path = os.path.join(directory, 'turns.jsonl')
+        os.makedirs(os.path.join(directory, 'rows'), exist_ok=True)
+        self._passage_ids = {p['id'] for p in _read_jsonl(self.passages_path)}
+        self._turn_ids = {t['id'] for t in _read_jsonl(self.turns_path)}
+        self._passages = None
+        self._turns = None
+
+    def rows_path(self, file_path):
+        return os.path.join(self.directory, 'rows', os.path.splitext(os.path.basename(file_path))[0] + '.jsonl')
+
+    """
+    Writes a batch of rows of the log `file_path`; the log sink's backend interface. New passages and
+    turns are written before the rows referring to them.
+    """
+    def write_rows(self, file_path, header, rows):
+        passages, turns = [], []
+        encoded = [self._encode_row(header, row, passages, turns) for row in rows]
+
+        for path, records in [(self.passages_path, passages), (self.turns_path, turns)]:
+            if records:
+                with open(path, 'a', encoding='UTF8') as f:
+                    f.writelines(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in records)
+
+        rows_path = self.rows_path(file_path)
+        file_exists = os.path.exists(rows_path)
+        with open(rows_path, 'a', encoding='UTF8') as f:
+            if not file_exists:
+                f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            f.writelines(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in encoded)
+
+    def _encode_row(self, header, row, passages, turns):
+        encoded = []
+        for i, value in enumerate(row):
+            column = header[i] if i < len(header) else None
+            if column in PASSAGE_COLUMNS and isinstance(value, list) and all(hasattr(d, 'page_content') for d in value):
+                value = {'passages': [self._add_passage(d, passages) for d in value]}
+            elif column in HISTORY_COLUMNS and isinstance(value, list):
+                value = self._add_history(value, turns)
+            encoded.append(value)
+        return encoded
+
+    def _add_passage(self, document, passages):
+        metadata = dict(document.metadata)
+        # the position of result_id is kept so the metadata is rebuilt in its original key order
+        position = list(metadata).index('result_id') if 'result_id' in metadata else None
+        result_id = metadata.pop('result_id', None)
+        passage = {'page_content': document.page_content, 'metadata': metadata}
+        passage_id = _hash(passage)
+        if passage_id not in self._passage_ids:
+            self._passage_ids.add(passage_id)
+            passages.append({'id': passage_id, **passage})
+        return [passage_id, result_id, position]
+
+    # The summary of the earlier conversation comes first in a logged history, see ChatHistory.to_list()
+    def _add_history(self, history, turns):
+        history = [list(turn) for turn in history]
+        summary = history.pop(0)[1] if history and history[0][0] == "Summary" else ""
+        turn_ids = []
+        for turn in history:
+            turn_id = _hash(turn)
+            if turn_id not in self._turn_ids:
+                self._turn_ids.add(turn_id)
+                turns.append({'id': turn_id, 'turn': turn})
+            turn_ids.append(turn_id)
+        return {'summary': summary, 'turns': turn_ids}
+
+    def close(self):
+        pass
+
+    def _load(self):
+        # Read on first use only; a log has far fewer distinct passages and turns than rows
+        if self._passages is None:
+            self._passages = {p['id']: p for p in _read_jsonl(self.passages_path)}
+            self._turns = {t['id']: t for t in _read_jsonl(self.turns_path)}
+
+    def _decode(self, value):
+        if isinstance(value, dict) and set(value) == {'passages'}:
+            documents = []
+            for passage_id, result_id, *position in value['passages']:
+                passage = self._passages[passage_id]
+                metadata = dict(passage['metadata'])
+                if position and position[0] is not None:
+                    items = list(metadata.items())
+                    items.insert(position[0], ('result_id', result_id))
+                    metadata = dict(items)
+                elif result_id is not None:
+                    # rows written before the position was stored
+                    metadata['result_id'] = result_id
+                documents.append(Document(page_content=passage['page_content'], metadata=metadata))
+            return documents
+        if isinstance(value, dict) and set(value) == {'summary', 'turns'}:
+            summary = [("Summary", value['summary'])] if value['summary'] else []
+            return summary + [tuple(self._turns[turn_id]['turn']) for turn_id in value['turns']]
+        if isinstance(value, dict) and set(value) == {'turn'}:
+            # rows written when a history was stored as a chain of turns
+            history, turn_id = [], value['turn']
+            while turn_id is not None:
+                turn = self._turns[turn_id]
+                history.append(tuple(turn['turn']))
+                turn_id = turn['prev']
+            return history[::-1]
+        return value
+
+    """
+    Streams the rows of the log `file_path` as lists, with source documents and chat histories
+    resolved. The first list is the header.
+    """
+    def read(self, file_path):
+        self._load()
+        rows = _read_jsonl(self.rows_path(file_path))
+        header = next(rows, None)
+        if header is None:
+            return
+        yield header
+        for row in rows:
+            yield [self._decode(v) for v in row]
+
+    """
+    Streams the rows of the log `file_path` as dicts keyed by the header, like csv.DictReader.
+    """
+    def read_dicts(self, file_path):
+        rows = self.read(file_path)
+        header = next(rows, None)
+        for row in rows:
+            yield {h: '' if v is None else v if isinstance(v, str) else str(v) for h, v in zip(header, row)}
+
+    """
+    Rebuilds the CSV the csv backend would have written for the log `file_path`.
+    """
+    def export(self, file_path, out_path):
+        count = 0
+        with open(out_path, 'w', encoding='UTF8', newline='') as f:
+            writer = csv.writer(f)
+            for row in self.read(file_path):
+                writer.writerow(row)
+                count += 1
+        return max(0, count - 1)
+
+    def stats(self):
+        sizes = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                sizes[os.path.relpath(os.path.join(root, name), self.directory)] = os.path.getsize(os.path.join(root, name))
+        return {'passages': len(self._passage_ids), 'turns': len(self._turn_ids), 'bytes': sizes}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "export":
+        out_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join("./app/prev_records", sys.argv[2])
+        print(f"Exported {ContentStore().export(sys.argv[2], out_path)} rows to {out_path}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "stats":
+        print(json.dumps(ContentStore().stats(), indent=2))
+    else:
+        print("usage: python app/logstore.py export <log, e.g. qna.csv> [out path] | stats")
@@ -1,6 +1,7 @@
 # standard library modules
 import os
 import re
+import uuid
 
 # third-party modules
 import streamlit as st
@@ -9,7 +10,6 @@ from dotenv import (
     find_dotenv,
     load_dotenv
 )
-from deep_translator import GoogleTranslator, single_detection
 
 # SUPPORTED LANGUAGES
 # langs_list = GoogleTranslator().get_supported_languages() 
@@ -17,39 +17,67 @@ from deep_translator import GoogleTranslator, single_detection
 # print(langs_list)
 
 # local modules
+from history import ChatHistory
 from function import (
-    conversational_chat,
+    respond,
     start_conversation,
     start_conversation_refine,
-    goodFeedback,
-    badFeedback
+    giveFeedback
 )
 
+from api_client import (
+    get_api_client,
+    respond_via_api
+)
+from session_store import (
+    load_state,
+    delete_state
+)
+from translation import translate_output
+
 from constants import (
-    TRANSLATOR_API_KEY
+    STREAMING,
+    CHAT_API_URL,
+    GENERATED_SESSION_TEXT,
+    PAST_SESSION_TEXT,
+    WELCOME_TEXT,
+    BUTTON_TEXT
 )
 
 load_dotenv(find_dotenv())
 
-# Default text
-generated_session_text = "Hello! I'm your guide for migrant domestic workers. Ask me anything!"
-past_session_text = "Hey! 👋"
-welcome_text = "How would you like us to help you today?"
-button_text = "Send"
-
-session_state_default = {
-    'history': [],
-    'generated': [generated_session_text],
-    'past': [past_session_text],
-    'queryid': [],
-    'resultids': [],
-}
-
-for name, value in session_state_default.items():
-    if name not in st.session_state:
-        st.session_state[name] = value
-
-chain = start_conversation()
+# Default text, shown in the user's language once it is known (pretranslated, see translation.py)
+generated_session_text = GENERATED_SESSION_TEXT
+past_session_text = PAST_SESSION_TEXT
+
+# With CHAT_API_URL set the turns are answered by the API (server.py) instead of in this process
+if CHAT_API_URL:
+    api = get_api_client(CHAT_API_URL)
+    feedback = api.feedback
+else:
+    chain = start_conversation(streaming=STREAMING)
+    feedback = giveFeedback
+
+"""
+Loads a conversation into st.session_state from the session store, or from the API, which keeps it
+in its own store. The welcome messages are shown before the stored turns.
+"""
+def start_session(session_id):
+    stored = api.load(session_id) if CHAT_API_URL else load_state(session_id)
+    st.session_state['session_id'] = session_id
+    st.session_state['history'] = stored['history'] if 'history' in stored else ChatHistory()
+    st.session_state['generated'] = [generated_session_text] + stored['generated']
+    st.session_state['past'] = [past_session_text] + stored['past']
+    st.session_state['queryid'] = stored['queryid']
+    st.session_state['resultids'] = stored['resultids']
+    st.session_state['lang'] = stored.get('lang', 'en')
+
+# The conversation id is kept in the page URL, so reloading the page (served by this or any other
+# replica) resumes the conversation
+if 'session_id' not in st.session_state:
+    session_id = st.experimental_get_query_params().get('sid', [uuid.uuid4().hex])[0]
+    st.experimental_set_query_params(sid=session_id)
+    start_session(session_id)
 
 # container for the chat history
 response_container = st.container()
@@ -61,56 +89,58 @@ with container:
     with st.form(key='sgwp', clear_on_submit=True):
 
         user_input = st.text_input(
-            welcome_text,
+            translate_output(WELCOME_TEXT, st.session_state['lang']),
             max_chars=200
         )
-        send_button = st.form_submit_button(label=button_text)
+        send_button = st.form_submit_button(label=translate_output(BUTTON_TEXT, st.session_state['lang']))
 
-        with st.spinner('loading...'):
-            if send_button and user_input:
-                lang = single_detection(user_input, api_key=TRANSLATOR_API_KEY)
-                print("------------DETECTED LANG------------:", lang)
-                print("---------------ORIGINAL--------------:", user_input)
-                
-                if lang != 'en':
-                    translated = GoogleTranslator(source='auto', target='en').translate(user_input)
-                    print("-------------TRANSLATED--------------:", translated)
-                    response_text = translated
-                    
-                else:
-                    response_text = user_input
+        # the answer is streamed here while it is generated, then moved into the chat history
+        stream_placeholder = st.empty()
 
-                response_text = "As a migrant domestic worker, " + response_text 
-                output = conversational_chat(
+        with st.spinner('loading...'):
+            if send_button and user_input and CHAT_API_URL:
+                respond_via_api(
+                    api,
+                    st.session_state['session_id'],
+                    user_input,
+                    st.session_state,
+                    placeholder=stream_placeholder if STREAMING else None
+                )
+            elif send_button and user_input:
+                respond(
                     chain,
-                    response_text
+                    user_input,
+                    st.session_state,
+                    placeholder=stream_placeholder if STREAMING else None
                 )
 
-                st.session_state['past'].append(user_input)
-                output = output.replace("$", "SGD")
-
-                if lang in ['sk', 'ceb']:
-                    lang = 'tl'
-
-                og = GoogleTranslator(source='en', target=lang).translate(output)
-                st.session_state['generated'].append(og)
-
     if st.button('Reset this conversation?'):
-        for name, value in session_state_default.items():
-            st.session_state[name] = value
+        if CHAT_API_URL:
+            api.delete(st.session_state['session_id'])
+        else:
+            delete_state(st.session_state['session_id'])
+        session_id = uuid.uuid4().hex
+        st.experimental_set_query_params(sid=session_id)
+        start_session(session_id)
 
 
 if st.session_state['generated']:
+    lang = st.session_state['lang']
     with response_container:
         for i in range(len(st.session_state['generated'])):
-            message(st.session_state["past"][i], is_user=True, key=str(i) + '_user', avatar_style="personas")
-            message(st.session_state["generated"][i], key=str(i), avatar_style="bottts")
+            past, generated = st.session_state["past"][i], st.session_state["generated"][i]
+            if i == 0:
+                past, generated = translate_output(past, lang), translate_output(generated, lang)
+            message(past, is_user=True, key=str(i) + '_user', avatar_style="personas")
+            message(generated, key=str(i), avatar_style="bottts")
 
             if (st.session_state['generated'][i] != generated_session_text):
                 col1, col2, col3, col4 = st.columns([2, 1, 1, 14])
+                # the message voted on, so that clicking a button again is not resubmitted to Kendra
+                click_key = st.session_state['session_id'] + ":" + str(i)
 
                 with col2:
-                    st.button('👍', key=st.session_state['queryid'][i-1]+"a", on_click=goodFeedback, args=(st.session_state['queryid'][i-1], st.session_state['resultids'][i-1]))
+                    st.button('👍', key=str(i) + "_" + st.session_state['queryid'][i-1]+"a", on_click=feedback, args=(st.session_state['queryid'][i-1], st.session_state['resultids'][i-1], "RELEVANT", click_key))
                 with col3:
-                    st.button('👎', key=st.session_state['queryid'][i-1]+"b", on_click=badFeedback, args=(st.session_state['queryid'][i-1], st.session_state['resultids'][i-1]))
+                    st.button('👎', key=str(i) + "_" + st.session_state['queryid'][i-1]+"b", on_click=feedback, args=(st.session_state['queryid'][i-1], st.session_state['resultids'][i-1], "NOT_RELEVANT", click_key))
                     
@@ -0,0 +1,149 @@
+# standard library modules
+import sys
+import threading
+import time
+from concurrent.futures import TimeoutError
+
+# third-party modules
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+
+# local modules
+from constants import (
+    CONDENSE_TIMEOUT,
+    RETRIEVAL_TIMEOUT,
+    CONDENSE_GATE
+)
+from cache import normalize_question
+from tracing import (
+    span,
+    mark,
+    submit,
+    TokenCounter
+)
+from gate import (
+    needs_rephrase,
+    log_decision
+)
+from combine import prepare_context
+
+"""
+Runs one turn of a ConversationalRetrievalChain with its independent stages overlapped.
+
+The chain itself runs condense -> retrieve -> answer strictly in sequence. Here, retrieval for the
+question as asked is started while the condense call is still in flight; when the condensed question
+comes back unchanged (the usual case for a new, self-contained question) the prefetched documents are
+used directly. Before that, a local gate decides whether the question needs rephrasing at all; when
+it does not, the condense call is skipped and the question goes straight to retrieval. The retrieved
+passages are trimmed (see combine.py) before the answer stage, which runs on the calling thread so
+that streaming callbacks can write to the Streamlit page. The source documents returned are the
+retrieved ones, untrimmed, as their links and result ids are shown to the user. A retrieval that takes
+longer than `retrieval_timeout` seconds is abandoned and the turn is answered without documents, i.e.
+with the helpline reply.
+
+Returns the same outputs as calling the chain: answer, source_documents and generated_question.
+"""
+def run_turn(chain, query, history, inputs=None, callbacks=None, retrieval_timeout=RETRIEVAL_TIMEOUT):
+    def retrieve(question):
+        with span('retrieve'):
+            return chain.retriever.get_relevant_documents(question)
+
+    def documents(retrieving):
+        try:
+            return retrieving.result(timeout=retrieval_timeout)
+        except TimeoutError:
+            # The worker finishes in the background
+            print("----------RETRIEVAL TIMEOUT----------:", retrieval_timeout, "s")
+            retrieving.cancel()
+            mark('retrieval_timeout')
+            return []
+
+    def condense():
+        with span('condense'):
+            return chain.question_generator.run(question=query, chat_history=chat_history_str, callbacks=[TokenCounter()])
+
+    inputs = dict(inputs or {})
+    get_chat_history = chain.get_chat_history or _get_chat_history
+    chat_history_str = get_chat_history(history)
+
+    rephrase = bool(history)
+    if history:
+        last_question = next((turn[0] for turn in reversed(history) if isinstance(turn, tuple)), "")
+        rephrase, reason, similarity = needs_rephrase(query, last_question)
+        rephrase = rephrase or not CONDENSE_GATE
+        print("-------------CONDENSE GATE-----------:", rephrase, reason)
+
+    if rephrase:
+        prefetch = submit(retrieve, query)
+        start = time.perf_counter()
+        condensing = submit(condense)
+        try:
+            new_question = condensing.result(timeout=CONDENSE_TIMEOUT)
+        except TimeoutError:
+            # Fall back to the question as asked; the worker finishes in the background
+            print("-----------CONDENSE TIMEOUT----------:", CONDENSE_TIMEOUT, "s")
+            condensing.cancel()
+            new_question = query
+        unchanged = normalize_question(new_question) == normalize_question(query)
+        log_decision(query, last_question, True, reason, similarity, round((time.perf_counter() - start) * 1000), not unchanged)
+
+        if unchanged:
+            docs = documents(prefetch)
+        else:
+            prefetch.cancel()
+            docs = documents(submit(retrieve, new_question))
+    else:
+        if history:
+            log_decision(query, last_question, False, reason, similarity)
+        new_question = query
+        docs = documents(submit(retrieve, query))
+
+    with span('combine') as attributes:
+        context = prepare_context(chain, docs, new_question, attributes)
+
+    inputs["question"] = new_question if chain.rephrase_question else query
+    inputs["chat_history"] = chat_history_str
+    with span('answer'):
+        answer = chain.combine_docs_chain.run(input_documents=context, callbacks=(callbacks or []) + [TokenCounter()], **inputs)
+
+    return {
+        "answer": answer,
+        "source_documents": docs,
+        "generated_question": new_question,
+    }
+
+
+"""
+Checks that a turn whose retrieval hangs is still answered, without documents:
+    python app/pipeline.py check
+"""
+def check():
+    release = threading.Event()
+
+    class Retriever:
+        def get_relevant_documents(self, question):
+            release.wait()
+            return []
+
+    class Answer:
+        def run(self, input_documents, callbacks, **inputs):
+            return "helpline" if not input_documents else "answer"
+
+    class Chain:
+        retriever = Retriever()
+        combine_docs_chain = Answer()
+        get_chat_history = None
+        rephrase_question = False
+
+    start = time.perf_counter()
+    result = run_turn(Chain(), "How many rest days do I get?", [], retrieval_timeout=0.2)
+    release.set()
+    assert result["answer"] == "helpline" and result["source_documents"] == [], result
+    assert time.perf_counter() - start < 5, "the turn waited for the retriever"
+    print("retrieval timeout check passed")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        check()
+    else:
+        print("usage: python app/pipeline.py check")
@@ -0,0 +1,66 @@
+# standard library modules
+import threading
+import time
+
+# third-party modules
+import tiktoken
+
+"""
+A token bucket refilled continuously at `rate_per_minute`, holding at most one minute of capacity.
+"""
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds to wait until `amount` is available, taking it if it already is
+    def try_take(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+"""
+Limits calls to an API with both a requests-per-minute and a tokens-per-minute budget, as OpenAI
+does. acquire() blocks until one request and the estimated number of tokens fit in both budgets.
+"""
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                wait = self.requests.try_take(1)
+                if not wait:
+                    wait = self.tokens.try_take(tokens)
+                    if wait:
+                        # give the request back until the tokens are available too
+                        self.requests.tokens += 1
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+_encoding = None
+
+def count_tokens(text, model_name='gpt-3.5-turbo'):
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+    return len(_encoding.encode(text))
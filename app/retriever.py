@@ -0,0 +1,191 @@
+# standard library modules
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError
+)
+from typing import Any, List
+
+# third-party modules
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun
+)
+from langchain.retrievers import AmazonKendraRetriever
+from langchain.schema import BaseRetriever, Document
+
+# local modules
+from constants import (
+    KENDRA_INDEX_ID,
+    AWS_DEFAULT_REGION,
+    RETRIEVAL_CACHE_BYTES,
+    RETRIEVAL_CACHE_TTL,
+    INDEX_VERSION_CHECK_INTERVAL,
+    RETRIEVER_BACKEND,
+    LOCAL_INDEX_DIR,
+    KENDRA_FALLBACK_TIMEOUT,
+    HTTP_POOL_SIZE
+)
+from clients import (
+    get_or_create,
+    get_kendra_client
+)
+from cache import (
+    Cache,
+    normalize_question
+)
+from local_retriever import (
+    LocalIndex,
+    LocalRetriever
+)
+
+"""
+Tracks the version of a Kendra index so cached results can be dropped once the index is re-synced.
+The version is derived from describe_index (last update time and indexed document statistics) and is
+refreshed at most once every `interval` seconds.
+"""
+class IndexVersion:
+    def __init__(self, client, index_id, interval):
+        self.client = client
+        self.index_id = index_id
+        self.interval = interval
+        self._version = ""
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        if time.time() - self._checked < self.interval:
+            return self._version
+
+        with self._lock:
+            if time.time() - self._checked >= self.interval:
+                try:
+                    index = self.client.describe_index(Id=self.index_id)
+                    self._version = json.dumps([index.get('UpdatedAt'), index.get('IndexStatistics')], default=str, sort_keys=True)
+                except Exception as e:
+                    # Keep serving with the last known version rather than failing the turn
+                    print("-----------INDEX VERSION ERROR-------:", e)
+                self._checked = time.time()
+        return self._version
+
+
+"""
+Wraps a retriever and caches the documents it returns per normalised query. The cache is bounded by
+the total size of the cached documents and is cleared whenever the index version changes.
+"""
+class CachedRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    cache: Any
+    index_version: Any = None
+    last_version: str = ""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _check_version(self):
+        if self.index_version is None:
+            return
+        version = self.index_version.current()
+        if version != self.last_version:
+            if self.last_version:
+                print("-----------INDEX RE-SYNCED-----------: clearing retrieval cache")
+                self.cache.clear()
+            self.last_version = version
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        self._check_version()
+        key = normalize_question(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return [Document(page_content=d['page_content'], metadata=d['metadata']) for d in cached]
+
+        docs = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        self.cache.put(key, [{'page_content': d.page_content, 'metadata': d.metadata} for d in docs])
+        return docs
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        self._check_version()
+        key = normalize_question(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return [Document(page_content=d['page_content'], metadata=d['metadata']) for d in cached]
+
+        docs = await self.retriever.aget_relevant_documents(query, callbacks=run_manager.get_child())
+        self.cache.put(key, [{'page_content': d.page_content, 'metadata': d.metadata} for d in docs])
+        return docs
+
+
+"""
+Threads the guarded queries of FallbackRetriever run on. They are kept apart from the shared pipeline
+pool, which the retrieval itself may be running on: a query queued behind its own caller in a
+saturated pool would always time out.
+"""
+def get_fallback_executor():
+    return get_or_create('fallback_executor', lambda: ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix='retrieval'))
+
+
+"""
+Queries `retriever` and answers from `fallback` instead when it fails or takes longer than `timeout`
+seconds. A timed out query keeps running in the background and still fills the retrieval cache.
+"""
+class FallbackRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    fallback: BaseRetriever
+    timeout: float
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        try:
+            # the caller's context goes along, so the query's spans belong to its trace
+            context = contextvars.copy_context()
+            future = get_fallback_executor().submit(context.run, self.retriever.get_relevant_documents, query, callbacks=run_manager.get_child())
+            return future.result(timeout=self.timeout)
+        except Exception as e:
+            print("-----------RETRIEVAL FALLBACK--------:", "timeout" if isinstance(e, TimeoutError) else e)
+            return self.fallback.get_relevant_documents(query, callbacks=run_manager.get_child())
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        try:
+            return await asyncio.wait_for(self.retriever.aget_relevant_documents(query, callbacks=run_manager.get_child()), self.timeout)
+        except Exception as e:
+            print("-----------RETRIEVAL FALLBACK--------:", "timeout" if isinstance(e, asyncio.TimeoutError) else e)
+            return await self.fallback.aget_relevant_documents(query, callbacks=run_manager.get_child())
+
+
+def _documents_size(docs):
+    return sum(len(d['page_content']) + len(json.dumps(d['metadata'], default=str)) for d in docs) or 1
+
+
+def get_retrieval_cache():
+    return get_or_create('retrieval_cache', lambda: Cache(RETRIEVAL_CACHE_BYTES, RETRIEVAL_CACHE_TTL, getsizeof=_documents_size))
+
+
+def get_index_version():
+    return get_or_create('index_version', lambda: IndexVersion(get_kendra_client(), KENDRA_INDEX_ID, INDEX_VERSION_CHECK_INTERVAL))
+
+
+"""
+The Kendra retriever used by the chains, behind the shared retrieval cache.
+"""
+def get_kendra_retriever(top_k=3):
+    retriever = AmazonKendraRetriever(index_id=KENDRA_INDEX_ID, top_k=top_k, region=AWS_DEFAULT_REGION, client=get_kendra_client())
+    return CachedRetriever(retriever=retriever, cache=get_retrieval_cache(), index_version=get_index_version())
+
+
+def get_local_index():
+    return get_or_create('local_index', lambda: LocalIndex(LOCAL_INDEX_DIR))
+
+
+"""
+The retriever used by the chains, selected by RETRIEVER_BACKEND: Kendra, the local index built by
+local_retriever.py, or Kendra with the local index as a fallback.
+"""
+def get_retriever(top_k=3):
+    if RETRIEVER_BACKEND == "local":
+        return LocalRetriever(index=get_local_index(), top_k=top_k)
+    if RETRIEVER_BACKEND == "fallback":
+        return FallbackRetriever(retriever=get_kendra_retriever(top_k), fallback=LocalRetriever(index=get_local_index(), top_k=top_k), timeout=KENDRA_FALLBACK_TIMEOUT)
+    return get_kendra_retriever(top_k)
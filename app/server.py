@@ -0,0 +1,313 @@
+# standard library modules
+import argparse
+import asyncio
+import contextvars
+import json
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# third-party modules
+from aiohttp import web
+from cachetools import TTLCache
+
+# local modules
+from constants import (
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    SERVER_TURN_WORKERS,
+    CONVERSATION_TTL,
+    MAX_CONVERSATIONS,
+    TURN_LOCK_TTL
+)
+from clients import (
+    get_or_create,
+    get_key_pool
+)
+from streaming import CURSOR
+from function import (
+    respond,
+    start_conversation,
+    giveFeedback
+)
+from session_store import (
+    get_session_store,
+    load_state
+)
+
+"""
+An HTTP API for chat clients other than the Streamlit page, e.g. messaging bridges.
+
+    POST /chat                {"conversation_id"?, "message"} -> {"conversation_id", "answer", "queryid", "resultids", "lang"}
+    POST /chat/stream         the same, as server-sent events: "delta" / "replace" events with the
+                              answer so far, then a "done" event with the JSON above
+    POST /feedback            {"queryid", "resultids", "relevance": "RELEVANT" | "NOT_RELEVANT", "click_key"?}
+                              click_key names the message voted on, so a repeated click is not resubmitted
+    DELETE /conversations/ID  forgets a conversation
+    GET /conversations/ID     {"past", "generated", "queryid", "resultids", "lang"} of a conversation
+    GET /healthz
+    GET /metrics              {"openai_keys": per-key utilization of the OpenAI key pool}
+
+Conversation state is passed to respond() explicitly. It is kept in the session store (see
+session_store.py), so any worker or replica sharing the store can serve any conversation, with a
+per-process copy cached for CONVERSATION_TTL seconds after its last turn. Turns run on a thread pool,
+one at a time per conversation, so a worker serves many conversations at once. The turns of a
+conversation are serialised within a process by an asyncio lock and across processes and replicas
+by a lock in the session store, so no sticky routing is needed. Several worker processes can share
+the port:
+    python app/server.py --workers 4
+"""
+
+
+"""
+Conversation states by id, cached for CONVERSATION_TTL seconds after their last turn. A cached state
+is loaded again when another process has since added turns to the conversation in the store.
+"""
+class Conversations:
+    def __init__(self, maxsize, ttl):
+        self._states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._turn_locks = {} # conversation_id -> [lock, users], only used from the event loop
+
+    """
+    Holds the lock serialising the turns of a conversation; the lock is dropped with its last user.
+    Within the process an asyncio lock queues the turns, and the holder then takes the conversation's
+    lock in the session store, which the other processes sharing the store also take.
+    """
+    @asynccontextmanager
+    async def turn(self, conversation_id):
+        entry = self._turn_locks.setdefault(conversation_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._store_lock(conversation_id):
+                    yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._turn_locks[conversation_id]
+
+    @asynccontextmanager
+    async def _store_lock(self, conversation_id):
+        store = get_session_store()
+        if store is None:
+            yield
+            return
+        owner = uuid.uuid4().hex
+        delay = 0.02
+        while not await _in_thread(store.acquire_lock, conversation_id, owner, TURN_LOCK_TTL):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        try:
+            yield
+        finally:
+            await _in_thread(store.release_lock, conversation_id, owner)
+
+    """
+    Returns the state of a conversation, loading it from the store if needed. Blocking; called from
+    the turn's worker thread.
+    """
+    def state(self, conversation_id):
+        with self._lock:
+            state = self._states.get(conversation_id)
+        store = get_session_store()
+        if state is None or (store is not None and store.count(conversation_id) != len(state['past'])):
+            state = load_state(conversation_id)
+        with self._lock:
+            # re-inserting restarts the TTL
+            self._states[conversation_id] = state
+        return state
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._states.pop(conversation_id, None)
+        if get_session_store() is not None:
+            get_session_store().delete(conversation_id)
+
+
+"""
+Stands in for the Streamlit placeholder the StreamHandler writes to, turning each update of the
+streamed answer into an event for the response. Called from the turn's worker thread.
+"""
+class EventPlaceholder:
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.text = ""
+
+    def markdown(self, text):
+        text = text[:-len(CURSOR)] if text.endswith(CURSOR) else text
+        if text.startswith(self.text):
+            event = ('delta', {'text': text[len(self.text):]})
+        else:
+            event = ('replace', {'text': text})
+        self.text = text
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def empty(self):
+        pass
+
+
+def get_turn_executor():
+    return get_or_create('turn_executor', lambda: ThreadPoolExecutor(max_workers=SERVER_TURN_WORKERS, thread_name_prefix='turn'))
+
+
+def _in_thread(fn, *args):
+    # A fresh context per call, so a turn's trace does not leak between requests
+    return asyncio.get_running_loop().run_in_executor(get_turn_executor(), contextvars.Context().run, fn, *args)
+
+
+async def _run_turn(app, conversation_id, message, placeholder=None):
+    def turn():
+        state = app['conversations'].state(conversation_id)
+        answer = respond(app['chain'], message, state, placeholder)
+        return {
+            'conversation_id': conversation_id,
+            'answer': answer,
+            'queryid': state['queryid'][-1],
+            'resultids': state['resultids'][-1],
+            'lang': state['lang'],
+        }
+
+    async with app['conversations'].turn(conversation_id):
+        return await _in_thread(turn)
+
+
+async def _read_json(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="expected a JSON body")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="expected a JSON object")
+    return body
+
+
+async def _read_message(request):
+    body = await _read_json(request)
+    message = body.get('message')
+    if not isinstance(message, str) or not message.strip():
+        raise web.HTTPBadRequest(text="'message' is required")
+    conversation_id = body.get('conversation_id') or uuid.uuid4().hex
+    if not isinstance(conversation_id, str):
+        raise web.HTTPBadRequest(text="'conversation_id' must be a string")
+    return conversation_id, message.strip()
+
+
+async def chat(request):
+    conversation_id, message = await _read_message(request)
+    return web.json_response(await _run_turn(request.app, conversation_id, message))
+
+
+async def chat_stream(request):
+    conversation_id, message = await _read_message(request)
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    queue = asyncio.Queue()
+    turn = asyncio.ensure_future(_run_turn(request.app, conversation_id, message, EventPlaceholder(asyncio.get_running_loop(), queue)))
+    while True:
+        getter = asyncio.ensure_future(queue.get())
+        done, _ = await asyncio.wait({getter, turn}, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            event, data = getter.result()
+            await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+            continue
+        getter.cancel()
+        break
+
+    # events queued before the turn finished
+    while not queue.empty():
+        event, data = queue.get_nowait()
+        await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+    try:
+        await response.write(f"event: done\ndata: {json.dumps(turn.result())}\n\n".encode())
+    except Exception as e:
+        print("--------------API ERROR--------------:", e)
+        await response.write(f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode())
+    await response.write_eof()
+    return response
+
+
+async def feedback(request):
+    body = await _read_json(request)
+    queryid, resultids = body.get('queryid'), body.get('resultids', [])
+    if not isinstance(queryid, str) or not queryid:
+        raise web.HTTPBadRequest(text="'queryid' is required")
+    if not isinstance(resultids, list) or not all(isinstance(r, str) for r in resultids):
+        raise web.HTTPBadRequest(text="'resultids' must be a list of strings")
+    if body.get('relevance') not in ("RELEVANT", "NOT_RELEVANT"):
+        raise web.HTTPBadRequest(text="'relevance' must be RELEVANT or NOT_RELEVANT")
+    if not isinstance(body.get('click_key'), (str, type(None))):
+        raise web.HTTPBadRequest(text="'click_key' must be a string")
+    giveFeedback(queryid, resultids, body['relevance'], body.get('click_key'))
+    return web.json_response({'status': 'queued'})
+
+
+async def delete_conversation(request):
+    await _in_thread(request.app['conversations'].delete, request.match_info['conversation_id'])
+    return web.json_response({'status': 'deleted'})
+
+
+async def get_conversation(request):
+    state = await _in_thread(request.app['conversations'].state, request.match_info['conversation_id'])
+    return web.json_response({name: state[name] for name in ['past', 'generated', 'queryid', 'resultids', 'lang']})
+
+
+async def healthz(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def metrics(request):
+    return web.json_response({'openai_keys': get_key_pool().stats()})
+
+
+@web.middleware
+async def errors(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        print("--------------API ERROR--------------:", e)
+        return web.json_response({'error': str(e)}, status=500)
+
+
+def create_app():
+    app = web.Application(middlewares=[errors])
+    app['conversations'] = Conversations(MAX_CONVERSATIONS, CONVERSATION_TTL)
+    app['chain'] = start_conversation(streaming=True)
+    app.add_routes([
+        web.post('/chat', chat),
+        web.post('/chat/stream', chat_stream),
+        web.post('/feedback', feedback),
+        web.get('/conversations/{conversation_id}', get_conversation),
+        web.delete('/conversations/{conversation_id}', delete_conversation),
+        web.get('/healthz', healthz),
+        web.get('/metrics', metrics),
+    ])
+    return app
+
+
+def serve(host, port, reuse_port=False):
+    web.run_app(create_app(), host=host, port=port, reuse_port=reuse_port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the chatbot over HTTP.")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help="processes sharing the port (SO_REUSEPORT)")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        serve(args.host, args.port)
+    else:
+        workers = [multiprocessing.Process(target=serve, args=(args.host, args.port, True)) for _ in range(args.workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
@@ -0,0 +1,254 @@
+# standard library modules
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# local modules
+from constants import (
+    SESSION_STORE,
+    SESSION_DB_PATH,
+    SESSION_REDIS_URL,
+    SESSION_TTL
+)
+from clients import get_or_create
+from history import ChatHistory
+
+"""
+Conversation state kept outside the process, so a conversation survives restarts and can be served
+by any replica.
+
+A conversation is stored as an append-only list of compact per-turn records plus its latest history
+summary; nothing is ever rewritten as a whole. A conversation expires SESSION_TTL seconds after its
+last write. Backends: "sqlite" (an embedded database in WAL mode, shared by every process on the
+host), "redis" (any Redis-compatible server, shared across hosts; needs the redis package) or "none".
+"""
+
+# keys of a turn record
+PAST, GENERATED, QUERYID, RESULTIDS, QUERY, ANSWER, LANG = "p", "g", "qid", "rid", "q", "a", "l"
+
+
+"""
+Stores conversations in SQLite: one row per turn, and one row per conversation holding the summary
+and the expiry time. Turns are ordered by an AUTOINCREMENT key, so processes appending to the same
+conversation at once never collide. Turn locks are rows of turn_locks with an owner and an expiry.
+"""
+class SqliteSessionStore:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, summary TEXT, summarized INTEGER, expires REAL)')
+        if [r[1] for r in self._db.execute('PRAGMA table_info(turns)') if r[5]] == ['session_id', 'seq']:
+            # turns numbered per conversation, as written by earlier versions
+            self._db.execute('ALTER TABLE turns RENAME TO turns_numbered')
+        self._db.execute('CREATE TABLE IF NOT EXISTS turns (seq INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, record TEXT)')
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'turns_numbered'").fetchone():
+            self._db.execute('INSERT INTO turns (session_id, record) SELECT session_id, record FROM turns_numbered ORDER BY session_id, seq')
+            self._db.execute('DROP TABLE turns_numbered')
+        self._db.execute('CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, seq)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS turn_locks (session_id TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._pruned = 0.0
+
+    def load(self, session_id):
+        with self._lock:
+            session = self._db.execute('SELECT summary, summarized, expires FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if session is None or session[2] < time.time():
+                return None
+            records = [json.loads(r[0]) for r in self._db.execute('SELECT record FROM turns WHERE session_id = ? ORDER BY seq', (session_id,))]
+            return records, session[0] or "", session[1] or 0
+
+    def count(self, session_id):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM turns WHERE session_id = ?', (session_id,)).fetchone()[0]
+
+    def append_turn(self, session_id, record):
+        with self._lock:
+            self._touch(session_id)
+            self._db.execute(
+                'INSERT INTO turns (session_id, record) VALUES (?, ?)',
+                (session_id, json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            )
+            self._prune()
+            self._db.commit()
+
+    def save_summary(self, session_id, summary, summarized):
+        with self._lock:
+            self._touch(session_id)
+            self._db.execute('UPDATE sessions SET summary = ?, summarized = ? WHERE session_id = ?', (summary, summarized, session_id))
+            self._db.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute('DELETE FROM turns WHERE session_id = ?', (session_id,))
+            self._db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self._db.commit()
+
+    """
+    Takes the turn lock of a conversation for `owner`, unless another owner holds it and it has not
+    expired. Returns whether the lock was taken.
+    """
+    def acquire_lock(self, session_id, owner, ttl):
+        with self._lock:
+            now = time.time()
+            cursor = self._db.execute(
+                'INSERT INTO turn_locks (session_id, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE turn_locks.expires < ?',
+                (session_id, owner, now + ttl, now)
+            )
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def release_lock(self, session_id, owner):
+        with self._lock:
+            self._db.execute('DELETE FROM turn_locks WHERE session_id = ? AND owner = ?', (session_id, owner))
+            self._db.commit()
+
+    def _touch(self, session_id):
+        self._db.execute(
+            "INSERT INTO sessions (session_id, summary, summarized, expires) VALUES (?, '', 0, ?) "
+            'ON CONFLICT(session_id) DO UPDATE SET expires = excluded.expires',
+            (session_id, time.time() + self.ttl)
+        )
+
+    # Drops expired conversations, at most once a minute
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        self._db.execute('DELETE FROM turns WHERE session_id IN (SELECT session_id FROM sessions WHERE expires < ?)', (now,))
+        self._db.execute('DELETE FROM sessions WHERE expires < ?', (now,))
+
+
+"""
+Stores conversations in Redis: a list of turn records and a hash with the summary per conversation,
+both given the TTL again on every write.
+"""
+class RedisSessionStore:
+    def __init__(self, url, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("SESSION_STORE=redis needs the redis package: pip install redis")
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+
+    def load(self, session_id):
+        pipe = self._redis.pipeline()
+        pipe.lrange(f"session:{session_id}:turns", 0, -1)
+        pipe.hgetall(f"session:{session_id}:meta")
+        records, meta = pipe.execute()
+        if not records and not meta:
+            return None
+        return [json.loads(r) for r in records], meta.get(b'summary', b'').decode(), int(meta.get(b'summarized', 0))
+
+    def count(self, session_id):
+        return self._redis.llen(f"session:{session_id}:turns")
+
+    def append_turn(self, session_id, record):
+        pipe = self._redis.pipeline()
+        pipe.rpush(f"session:{session_id}:turns", json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        pipe.expire(f"session:{session_id}:turns", self.ttl)
+        pipe.expire(f"session:{session_id}:meta", self.ttl)
+        pipe.execute()
+
+    def save_summary(self, session_id, summary, summarized):
+        pipe = self._redis.pipeline()
+        pipe.hset(f"session:{session_id}:meta", mapping={'summary': summary, 'summarized': summarized})
+        pipe.expire(f"session:{session_id}:meta", self.ttl)
+        pipe.expire(f"session:{session_id}:turns", self.ttl)
+        pipe.execute()
+
+    def delete(self, session_id):
+        self._redis.delete(f"session:{session_id}:turns", f"session:{session_id}:meta")
+
+    def acquire_lock(self, session_id, owner, ttl):
+        return bool(self._redis.set(f"session:{session_id}:lock", owner, nx=True, ex=ttl))
+
+    def release_lock(self, session_id, owner):
+        # deleted only while still held by `owner`
+        self._redis.eval(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+            1, f"session:{session_id}:lock", owner
+        )
+
+
+def _create_session_store():
+    if SESSION_STORE == 'redis':
+        return RedisSessionStore(SESSION_REDIS_URL, SESSION_TTL)
+    if SESSION_STORE == 'sqlite':
+        return SqliteSessionStore(SESSION_DB_PATH, SESSION_TTL)
+    return None
+
+
+def get_session_store():
+    return get_or_create('session_store', _create_session_store)
+
+
+def _history(session_id, store):
+    history = ChatHistory()
+    history.on_summary = lambda summary, summarized: store.save_summary(session_id, summary, summarized)
+    return history
+
+
+"""
+Loads the state of a conversation, in the form respond() works on: the chat history, the
+'past', 'generated', 'queryid' and 'resultids' lists and the 'lang' of the last message. A
+conversation that is unknown or expired starts empty. The state carries its 'session_id', so
+respond() records each turn to the store. The history is restored as it was saved, without
+summarizing anything again.
+"""
+def load_state(session_id):
+    state = {'session_id': session_id, 'history': ChatHistory(), 'past': [], 'generated': [], 'queryid': [], 'resultids': [], 'lang': 'en'}
+    store = get_session_store()
+    if store is None:
+        return state
+
+    state['history'] = _history(session_id, store)
+    loaded = store.load(session_id)
+    if loaded is None:
+        return state
+
+    records, summary, summarized = loaded
+    for record in records:
+        state['past'].append(record[PAST])
+        state['generated'].append(record[GENERATED])
+        state['queryid'].append(record[QUERYID])
+        state['resultids'].append(record[RESULTIDS])
+        state['lang'] = record.get(LANG, state['lang'])
+    # turns already folded into the summary are not restored
+    state['history'].restore([(r[QUERY], r[ANSWER]) for r in records[summarized:]], summary, summarized)
+    return state
+
+
+def delete_state(session_id):
+    store = get_session_store()
+    if store is not None:
+        store.delete(session_id)
+
+
+"""
+Appends the turn just answered in `state` to the store, if the state belongs to a stored
+conversation.
+"""
+def record_turn(state):
+    session_id = state.get('session_id')
+    store = get_session_store() if session_id else None
+    if store is None:
+        return
+
+    query, answer, _ = state['history'].turns[-1]
+    store.append_turn(session_id, {
+        PAST: state['past'][-1],
+        GENERATED: state['generated'][-1],
+        QUERYID: state['queryid'][-1],
+        RESULTIDS: state['resultids'][-1],
+        QUERY: query,
+        ANSWER: answer,
+        LANG: state.get('lang', 'en'),
+    })
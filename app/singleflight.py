@@ -0,0 +1,58 @@
+# standard library modules
+import threading
+
+"""
+Coalesces concurrent calls for the same key into one: while a call for a key is in flight, further
+calls for that key wait for it and share its result (or its exception) instead of running again.
+"""
+class Group:
+    def __init__(self):
+        self.calls = 0 # calls that ran
+        self.shared = 0 # calls answered by another call in flight, i.e. upstream runs saved
+        self.max_waiting = 0 # most calls ever waiting on one call
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    """
+    Returns (fn(), shared), where shared tells whether the result came from a call already in flight.
+    """
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = {'done': threading.Event(), 'waiting': 0, 'result': None, 'error': None}
+                self.calls += 1
+                leader = True
+            else:
+                call['waiting'] += 1
+                self.shared += 1
+                self.max_waiting = max(self.max_waiting, call['waiting'])
+                leader = False
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call['done'].set()
+        return call['result'], False
+
+    def stats(self):
+        with self._lock:
+            total = self.calls + self.shared
+            return {
+                'calls': self.calls,
+                'shared': self.shared,
+                'shared_rate': self.shared / total if total else 0.0,
+                'max_waiting': self.max_waiting,
+                'in_flight': len(self._in_flight),
+            }
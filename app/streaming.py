@@ -0,0 +1,71 @@
+# standard library modules
+import time
+
+# third-party modules
+from langchain.callbacks.base import BaseCallbackHandler
+
+# local modules
+from translation import (
+    SENTENCE_END,
+    translate_segments,
+    translate_output
+)
+
+CURSOR = "▌"
+
+
+"""
+Streams answer tokens into a Streamlit placeholder as the LLM produces them.
+
+For English the raw tokens are shown directly. For any other language tokens are buffered until a
+sentence is complete, and each finished sentence is back-translated and shown, so the user starts
+reading before the whole answer has been generated.
+"""
+class StreamHandler(BaseCallbackHandler):
+    def __init__(self, placeholder, lang='en'):
+        self.placeholder = placeholder
+        self.lang = lang
+        self.text = "" # the raw English answer received so far
+        self.translated = "" # the back-translated sentences shown so far
+        self._pending = ""
+        self.first_token_at = None
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.text += token
+        if self.lang == 'en':
+            self.placeholder.markdown(self.text.replace("$", "SGD") + CURSOR)
+            return
+
+        self._pending += token
+        last = None
+        for last in SENTENCE_END.finditer(self._pending):
+            pass
+        if last is not None:
+            complete, self._pending = self._pending[:last.end()], self._pending[last.end():]
+            self._emit(complete)
+
+    def on_llm_end(self, response, **kwargs):
+        if self._pending:
+            self._emit(self._pending)
+            self._pending = ""
+
+    def _emit(self, text):
+        self.translated += translate_segments(text.replace("$", "SGD"), self.lang)
+        self.placeholder.markdown(self.translated + CURSOR)
+
+    """
+    Builds the final message from what has already been streamed, so only the part of `output`
+    that was not streamed (e.g. the source links) still needs translating.
+    """
+    def finalize(self, output):
+        self.placeholder.empty()
+        output = output.replace("$", "SGD")
+        streamed = self.text.replace("$", "SGD")
+        if self.lang == 'en':
+            return output
+        if not self.text or not output.startswith(streamed):
+            return translate_output(output, self.lang)
+
+        return translate_output(output, self.lang, translated_answer=self.translated)
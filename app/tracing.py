@@ -0,0 +1,204 @@
+# standard library modules
+import contextvars
+import json
+import math
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+# third-party modules
+import pytz
+from langchain.callbacks.base import BaseCallbackHandler
+
+# local modules
+from constants import MODEL_NAME
+from clients import get_executor
+from logsink import (
+    get_log_sink,
+    read_log
+)
+from ratelimit import count_tokens
+from cache import normalize_question
+from gate import QUESTION_PREFIX
+
+SPANS_PATH = "./app/prev_records/spans.csv"
+LATENCY_PATH = "./app/prev_records/latency.csv"
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+_listeners = []
+
+
+"""
+The spans of one chat turn. Spans may be recorded from several threads (see submit()).
+"""
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def durations(self):
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                totals[s['name']] = totals.get(s['name'], 0) + s['duration_ms']
+        return totals
+
+    def tokens(self):
+        with self._lock:
+            return {
+                'prompt_tokens': sum(s['attributes'].get('prompt_tokens', 0) for s in self.spans),
+                'completion_tokens': sum(s['attributes'].get('completion_tokens', 0) for s in self.spans),
+            }
+
+
+"""
+Registers fn(trace, total_ms) to be called with every finished trace, e.g. by the benchmark.
+"""
+def add_listener(fn):
+    _listeners.append(fn)
+
+
+def start_trace(name='turn'):
+    trace = Trace(name)
+    _current_trace.set(trace)
+    return trace
+
+
+"""
+Times the enclosed block as a span of the current trace; does nothing outside a trace. The yielded
+dict holds the span's attributes, e.g. token counts.
+"""
+@contextmanager
+def span(name, **attributes):
+    trace = _current_trace.get()
+    record = {'name': name, 'attributes': dict(attributes)}
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record['attributes']
+    finally:
+        _current_span.reset(token)
+        if trace is not None:
+            record['offset_ms'] = (start - trace.start) * 1000
+            record['duration_ms'] = (time.perf_counter() - start) * 1000
+            trace.add(record)
+
+
+"""
+Records a point in time, e.g. the first streamed token, as a span measured from the start of the trace.
+"""
+def mark(name, at=None, **attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        at = time.perf_counter() if at is None else at
+        trace.add({'name': name, 'attributes': attributes, 'offset_ms': 0.0, 'duration_ms': (at - trace.start) * 1000})
+
+
+"""
+Submits work to the shared thread pool so that its spans belong to the caller's trace.
+"""
+def submit(fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, fn, *args, **kwargs)
+
+
+"""
+Counts prompt and completion tokens of every LLM call with tiktoken (streamed responses carry no
+usage) and adds them to the span the call runs in.
+"""
+class TokenCounter(BaseCallbackHandler):
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._add('prompt_tokens', sum(count_tokens(m.content, MODEL_NAME) for batch in messages for m in batch))
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._add('prompt_tokens', sum(count_tokens(p, MODEL_NAME) for p in prompts))
+
+    def on_llm_end(self, response, **kwargs):
+        self._add('completion_tokens', sum(count_tokens(g.text, MODEL_NAME) for gen in response.generations for g in gen))
+
+    def _add(self, key, value):
+        record = _current_span.get()
+        if record is not None:
+            record['attributes'][key] = record['attributes'].get(key, 0) + value
+
+
+"""
+Ends a trace: writes its spans to SPANS_PATH and one row with the end-to-end latency, per-stage
+timings and token counts to LATENCY_PATH, which eval.py uses for the Performance criterion.
+"""
+def finish_trace(trace, **fields):
+    total_ms = trace.elapsed_ms()
+    _current_trace.set(None)
+    now = datetime.strftime(datetime.now(pytz.timezone('Asia/Singapore')), "%Y-%m-%d %H:%M:%S")
+
+    header = ["Time_Enquired", "TraceId", "Span", "Offset_ms", "Duration_ms", "Attributes"]
+    for s in trace.spans:
+        get_log_sink().write(SPANS_PATH, header, [now, trace.trace_id, s['name'], round(s['offset_ms']), round(s['duration_ms']), json.dumps(s['attributes'], default=str)])
+    get_log_sink().write(SPANS_PATH, header, [now, trace.trace_id, trace.name, 0, round(total_ms), json.dumps(fields, default=str)])
+
+    durations = {k: round(v) for k, v in trace.durations().items()}
+    tokens = trace.tokens()
+    header = ["Time_Enquired", "TraceId", "QueryId", "Original_Question", "Question", "Latency_ms", "Stages_ms", "Prompt_Tokens", "Completion_Tokens"]
+    data = [now, trace.trace_id, fields.get('queryid', ''), fields.get('user_input', ''), fields.get('question', ''), round(total_ms), json.dumps(durations), tokens['prompt_tokens'], tokens['completion_tokens']]
+    get_log_sink().write(LATENCY_PATH, header, data)
+
+    print("---------------TIMINGS---------------:", durations, "total", round(total_ms), "ms", tokens)
+    for listener in _listeners:
+        listener(trace, total_ms)
+    return total_ms
+
+
+"""
+Reads LATENCY_PATH into {normalised question: end-to-end latency in ms}, keyed by both the question
+as the user typed it and its English translation. The latest turn wins.
+"""
+def load_latencies(path=LATENCY_PATH):
+    latencies = {}
+    for row in read_log(path):
+        question = row['Question']
+        question = question[len(QUESTION_PREFIX):] if question.startswith(QUESTION_PREFIX) else question
+        for key in [row['Original_Question'], question]:
+            if key:
+                latencies[normalize_question(key)] = int(row['Latency_ms'])
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    # nearest-rank
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+"""
+Aggregates exported spans into p50 / p95 / p99 latencies per stage, e.g.
+    python app/tracing.py [./app/prev_records/spans.csv]
+"""
+def report(path=SPANS_PATH):
+    durations = {}
+    for row in read_log(path):
+        durations.setdefault(row['Span'], []).append(float(row['Duration_ms']))
+
+    print(f"{'stage':<16}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, values in sorted(durations.items(), key=lambda item: -percentile(item[1], 50)):
+        print(f"{name:<16}{len(values):>8}{percentile(values, 50):>10.0f}{percentile(values, 95):>10.0f}{percentile(values, 99):>10.0f}")
+    return durations
+
+
+if __name__ == "__main__":
+    report(*sys.argv[1:2])
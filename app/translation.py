@@ -0,0 +1,241 @@
+# standard library modules
+import json
+import os
+import re
+import sys
+
+# third-party modules
+from deep_translator import GoogleTranslator, single_detection
+from langdetect import DetectorFactory, detect_langs
+from langdetect.lang_detect_exception import LangDetectException
+
+# local modules
+from constants import (
+    TRANSLATOR_API_KEY,
+    SOURCES_HEADER,
+    LANG_DETECT_CONFIDENCE,
+    TRANSLATION_CACHE_SIZE,
+    TRANSLATION_CACHE_TTL,
+    TRANSLATION_BATCH_CHARS,
+    STATIC_TRANSLATIONS_PATH,
+    FAQ_LANGUAGES,
+    GENERATED_SESSION_TEXT,
+    PAST_SESSION_TEXT,
+    WELCOME_TEXT,
+    BUTTON_TEXT
+)
+from clients import (
+    get_or_create,
+    get_executor
+)
+from cache import Cache
+
+# langdetect is non-deterministic unless seeded
+DetectorFactory.seed = 0
+
+# langdetect codes that GoogleTranslator spells differently
+LANGDETECT_TO_GOOGLE = {
+    'zh-cn': 'zh-CN',
+    'zh-tw': 'zh-TW',
+    'he': 'iw',
+}
+
+# Scripts langdetect has no profile for, detected from their unicode block
+SCRIPT_LANGUAGES = [
+    (re.compile(r'[\u1000-\u109f]'), 'my'), # Burmese
+    (re.compile(r'[\u1780-\u17ff]'), 'km'), # Khmer
+    (re.compile(r'[\u0d80-\u0dff]'), 'si'), # Sinhala
+]
+
+# A sentence is complete once its closing punctuation is followed by whitespace, or at a line break
+SENTENCE_END = re.compile(r'(?<=[.!?:;])\s+|\n+')
+
+# Kept as they are in a translation: URLs (without trailing punctuation) and phone numbers, either
+# international (+<country code> ...), Singapore toll-free (1800 xxx xxxx) or Singapore 8-digit
+# numbers, which start with 3, 6, 8 or 9 (6438 5122)
+PASSTHROUGH = re.compile(
+    r'https?://\S+?(?=[.,;:!?)]*(?:\s|$))'
+    r'|(?<![\w+])(?:\+\d{1,3}(?:[ -]?\d{2,4}){2,4}|1800[ -]?\d{3}[ -]?\d{4}|[3689]\d{3}[ -]?\d{4})(?![\w-])'
+)
+LETTER = re.compile(r'[^\W\d_]')
+
+
+"""
+Detects the language of a message locally with langdetect, only falling back to the remote
+detectlanguage.com API when the local detector is not confident enough.
+"""
+def detect_language(text):
+    for pattern, lang in SCRIPT_LANGUAGES:
+        if pattern.search(text):
+            return lang
+
+    try:
+        best = detect_langs(text)[0]
+        if best.prob >= LANG_DETECT_CONFIDENCE:
+            return LANGDETECT_TO_GOOGLE.get(best.lang, best.lang)
+        print("-----------LOW CONFIDENCE------------:", best)
+    except LangDetectException as e:
+        print("-----------LANGDETECT ERROR----------:", e)
+
+    return single_detection(text, api_key=TRANSLATOR_API_KEY)
+
+
+def get_translation_cache():
+    return get_or_create('translation_cache', lambda: Cache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL))
+
+
+def _cache_key(source, target, text):
+    return "\x1f".join([source, target, text])
+
+
+"""
+GoogleTranslator.translate behind a cache shared by every session, keyed by (source, target, text).
+"""
+def translate(text, source, target):
+    translation_cache = get_translation_cache()
+    key = _cache_key(source, target, text)
+    translated = translation_cache.get(key)
+    if translated is None:
+        translated = GoogleTranslator(source=source, target=target).translate(text)
+        if translated is not None:
+            translation_cache.put(key, translated)
+    return translated
+
+
+"""
+Splits text into (piece, translatable) pairs that join back into the text: sentences are
+translatable, while the whitespace between them, URLs, phone numbers and pieces without any letter
+(e.g. bullets) are kept as they are.
+"""
+def split_segments(text):
+    segments = []
+
+    def add_sentences(part):
+        start = 0
+        for end in SENTENCE_END.finditer(part):
+            add_piece(part[start:end.start()])
+            segments.append((end.group(), False))
+            start = end.end()
+        add_piece(part[start:])
+
+    def add_piece(piece):
+        body = piece.strip()
+        if not LETTER.search(body):
+            segments.append((piece, False))
+            return
+        leading, trailing = piece[:len(piece) - len(piece.lstrip())], piece[len(piece.rstrip()):]
+        segments.extend([(leading, False), (body, True), (trailing, False)])
+
+    start = 0
+    for match in PASSTHROUGH.finditer(text):
+        add_sentences(text[start:match.start()])
+        segments.append((match.group(), False))
+        start = match.end()
+    add_sentences(text[start:])
+    return [(piece, translatable) for piece, translatable in segments if piece]
+
+
+"""
+The fixed texts of the chatbot (welcome strings, the helpline reply, the sources header) translated
+ahead of time per language, as {lang: {english segment: translation}}; see pretranslate().
+"""
+def get_static_translations():
+    def load():
+        if not os.path.exists(STATIC_TRANSLATIONS_PATH):
+            return {}
+        with open(STATIC_TRANSLATIONS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    return get_or_create('static_translations', load)
+
+
+# Translates sentences in one request, one sentence per line; returns None if the lines do not line up
+def _translate_batch(sentences, lang):
+    translated = GoogleTranslator(source='en', target=lang).translate("\n".join(sentences))
+    lines = translated.split("\n") if translated else []
+    return [line.strip() for line in lines] if len(lines) == len(sentences) else None
+
+
+"""
+Translates English text into `lang` segment by segment: URLs and phone numbers are kept, fixed
+texts come from the pretranslated table and other sentences from the shared cache. The sentences
+left are sent in batches of up to TRANSLATION_BATCH_CHARS characters, concurrently; a batch whose
+lines do not come back one for one is translated a sentence at a time.
+"""
+def translate_segments(text, lang):
+    if lang == 'en':
+        return text
+
+    segments = split_segments(text)
+    static = get_static_translations().get(lang, {})
+    translation_cache = get_translation_cache()
+    translated = {}
+    for piece, translatable in segments:
+        if translatable and piece not in translated:
+            found = static.get(piece) or translation_cache.get(_cache_key('en', lang, piece))
+            translated[piece] = found
+
+    batches, size = [], TRANSLATION_BATCH_CHARS
+    for sentence in [piece for piece, found in translated.items() if found is None]:
+        if size + len(sentence) > TRANSLATION_BATCH_CHARS:
+            batches.append([])
+            size = 0
+        batches[-1].append(sentence)
+        size += len(sentence) + 1
+
+    # the first batch is translated in this thread, the others in the shared pool
+    futures = [get_executor().submit(_translate_batch, batch, lang) for batch in batches[1:]]
+    results = ([_translate_batch(batches[0], lang)] if batches else []) + [future.result() for future in futures]
+    for batch, result in zip(batches, results):
+        for i, sentence in enumerate(batch):
+            if result is None or not result[i]:
+                translated[sentence] = translate(sentence, 'en', lang)
+            else:
+                translated[sentence] = result[i]
+                translation_cache.put(_cache_key('en', lang, sentence), result[i])
+
+    return "".join(translated[piece] or piece if translatable else piece for piece, translatable in segments)
+
+
+"""
+Back-translates a chat answer segment by segment (see translate_segments), so the source URLs and
+the helpline numbers are never sent for translation. `translated_answer` can be passed when the
+answer part has already been translated, e.g. while it was streamed; only the sources part after it
+is translated then.
+"""
+def translate_output(output, lang, translated_answer=None):
+    if lang == 'en':
+        return output
+    if translated_answer is None:
+        return translate_segments(output, lang)
+
+    answer, separator, sources = output.partition(SOURCES_HEADER)
+    return translated_answer.rstrip() + answer[len(answer.rstrip()):] + translate_segments(separator + sources, lang)
+
+
+"""
+Writes the pretranslated table of the fixed texts for FAQ_LANGUAGES to STATIC_TRANSLATIONS_PATH, e.g.
+    python app/translation.py pretranslate
+Review the file before deploying it: its translations are served as they are.
+"""
+def pretranslate():
+    # function.py imports this module; it is only needed by this offline job
+    from function import helpline_text
+
+    texts = [GENERATED_SESSION_TEXT, PAST_SESSION_TEXT, WELCOME_TEXT, BUTTON_TEXT, SOURCES_HEADER, helpline_text]
+    sentences = list(dict.fromkeys(piece for text in texts for piece, translatable in split_segments(text) if translatable))
+    table = {}
+    for lang in [l for l in FAQ_LANGUAGES if l != 'en']:
+        table[lang] = {sentence: translate(sentence, 'en', lang) for sentence in sentences}
+        print(f"{lang}: {len(sentences)} segments")
+
+    os.makedirs(os.path.dirname(STATIC_TRANSLATIONS_PATH), exist_ok=True)
+    with open(STATIC_TRANSLATIONS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(table, f, ensure_ascii=False, indent=1)
+    print(f"Wrote {STATIC_TRANSLATIONS_PATH}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "pretranslate":
+        pretranslate()
+    else:
+        print("usage: python app/translation.py pretranslate")